@@ -1,11 +1,25 @@
 import os
+import re
+import sys
 import yaml
 import time
+import heapq
+import argparse
 from datetime import datetime
-from logger_config import logger
+from logger_config import logger, set_log_level
 from back_up import BackupTask
+from compression import DEFAULT_CODECS, check_codec
+from scheduler import SectionJob, run_jobs
+from state import StateStore
+from metrics import METRICS_FORMATS, RunMetrics, write_metrics, profile_run
+from worlds import WORLD_PATTERNS
+from checksum import check_checksum_algorithm
+from verify import verify_section
+from throttle import IONICE_CLASSES, run_with_priority
 
 CONFIG_FILE = 'config.yaml'
+STATE_FILE = 'state.db'  # 运行状态和备份历史，程序不再改写配置文件
+STATE_STORE = None
 EXECEPTION_NOTIFICATION_PATH = ''
 LOG_LEVEL = ''
 
@@ -14,7 +28,22 @@ GLOBAL_FREQUENCY = ''
 GLOBAL_METHOD = ''
 GLOBAL_PREDEFINE_PATTERNS = ''
 WAKEUP_FREQUENCY = 7200
-ZIP_CHUNK_SIZE = 1024 * 1024 * 500  # 每次读取的块大小，500MB
+CONFIG_POLL_INTERVAL = 60  # 常驻模式下检查配置文件是否被修改的间隔，单位秒
+ZIP_CHUNK_SIZE = 1024 * 1024  # 压缩时的读取缓冲区大小，1MB
+ZIP_WORKERS = 0  # zip并行压缩的进程数，0表示使用全部CPU核心
+SCAN_WORKERS = 4  # 扫描源目录的线程数
+COPY_WORKERS = 8  # 同时复制文件的线程数
+VERIFY_WORKERS = 4  # 校验备份时同时计算哈希的线程数
+MAX_CONCURRENT_SECTIONS = 4  # 最多同时运行几个备份项
+DEVICE_CONCURRENCY = 1  # 同一个源设备、目标设备上最多同时运行几个备份项
+FULL_BACKUP_INTERVAL = 7  # 增量备份每隔多少次强制全量备份一次
+METRICS_PATH = ''  # 备份指标的输出目录，为空则不输出
+METRICS_FORMAT = 'jsonl'  # 备份指标的格式：jsonl或prometheus
+MAX_LOAD = 0  # 每核平均负载超过这个值时暂停备份，0表示不检查
+MAX_IOWAIT = 0  # I/O等待占比（百分比）超过这个值时暂停备份，0表示不检查
+
+BACKUP_METHODS = ['copy', 'zip', 'tar', 'incremental', 'snapshot']
+PREDEFINE_PATTERNS = ['all', 'none'] + WORLD_PATTERNS
 
 
 freq_dict = {
@@ -29,25 +58,50 @@ comments = {
     'common': {
         'global_destination': '全局目标路径',
         'global_frequency': '全局备份频率：daily（每天）, weekly（每周）, monthly（每月）等，也可以是秒数',
-        'global_method': '全局备份方法：copy（复制）, zip（压缩）等',
-        'global_predefine_patterns': '全局预定义备份模式，可选值：all（目录下除了排除项以外的所有文件）, none（不备份）',
+        'global_method': '全局备份方法：copy（复制）, zip（压缩）, tar（打包压缩）, incremental（增量）, snapshot（硬链接快照）等',
+        'global_predefine_patterns': '全局预定义备份模式，可选值：all（目录下除了排除项以外的所有文件）, none（不备份）, server_world_only（只备份服务器存档，即源目录下包含level.dat的文件夹）, mcdr_server_world_only（只备份MCDR服务器存档，源目录是MCDR根目录，存档在server文件夹下）。只备份存档时，区域文件（.mca）只有区块保存时间变了才算变化，适合高频的incremental或snapshot备份',
         'wakeup_frequency': '唤醒时间，单位秒，默认2小时',
-        'zip_chunk_size': '每次读取的块大小，单位字节，默认500MB',
-        'log_level': '日志等级，可选值：DEBUG, INFO, WARNING, ERROR, CRITICAL',
+        'zip_chunk_size': '压缩时的读取缓冲区大小，单位字节，默认1MB，最大64MB。文件以流的方式写入压缩包，内存占用与文件大小无关',
+        'zip_workers': 'zip并行压缩的进程数，0表示使用全部CPU核心，1表示不并行',
+        'scan_workers': '扫描源目录的线程数，默认4，1表示单线程扫描',
+        'copy_workers': '复制文件的线程数，大量小文件时可以明显加快复制，默认8',
+        'verify_workers': '用--verify校验备份时同时计算哈希的线程数，默认4',
+        'max_concurrent_sections': '最多同时运行几个备份项，默认4，1表示依次运行',
+        'device_concurrency': '同一块硬盘（分别按源目录和目标目录统计）上最多同时运行几个备份项，默认1，避免机械硬盘来回寻道',
+        'max_load': '系统繁忙时暂停备份：每核1分钟平均负载超过这个值时暂停，负载恢复后继续，暂停时间按指数退避增加，0表示不检查，默认0',
+        'max_iowait': '系统繁忙时暂停备份：I/O等待占CPU时间的百分比超过这个值时暂停，0表示不检查，默认0（仅Linux）',
+        'log_level': '日志等级，可选值：DEBUG, INFO, WARNING, ERROR, CRITICAL。逐个文件的日志（正在压缩、排除）只在DEBUG级别输出，INFO级别每隔一段时间输出一次进度',
+        'metrics_path': '（非必须）备份指标（各阶段耗时、读写量、压缩率、排除数量、最慢的文件等）的输出目录，为空则不输出',
+        'metrics_format': '备份指标的格式：jsonl（每次备份追加一行到metrics.jsonl）, prometheus（每个备份项一个.prom文件，供node_exporter的textfile collector读取），默认jsonl',
         'exception_notification_path' : '（非必须）报错告知目录，如果出现error，会把当前日志复制一份到这里',
 
     },
     'example': {
         'source_directory': '源目录【必选】',
         'destination_directory': '目标目录【可选】',
-        'backup_method': '备份方法：copy（复制）, zip（压缩）【可选】',
+        'backup_method': '备份方法：copy（复制）, zip（压缩）, tar（打包压缩）, incremental（增量，只复制变化的文件）, snapshot（完整快照，未变化的文件硬链接到上一个快照）【可选】',
+        'compression': '压缩算法，zip可选deflate, bzip2, lzma, store（不压缩），默认deflate；tar可选zstd, lz4, gzip, xz, bzip2, store，默认zstd（zstd和lz4需要额外安装zstandard、lz4）【可选】',
+        'compression_level': '压缩等级，不填则使用算法的默认等级，deflate为0-9，zstd为1-22，lz4为0-16【可选】',
+        'compression_threads': 'zstd的压缩线程数，0表示单线程，-1表示使用全部CPU核心，默认0【可选】',
+        'store_incompressible': 'zip压缩时，图片、视频、压缩包、区域文件等压缩不动的文件直接存储不压缩，默认true【可选】',
         'backup_frequency': '备份频率：daily（每天）, weekly（每周）, monthly（每月），yearly（每年）等，也可以是秒数【可选】',
-        'predefine_patterns': '预定义备份模式，可选值：all（目录下除了排除项以外的所有文件）, none（不备份）【可选】',
+        'predefine_patterns': '预定义备份模式，可选值：all（目录下除了排除项以外的所有文件）, none（不备份）, server_world_only（只备份服务器存档）, mcdr_server_world_only（只备份MCDR服务器存档）【可选】',
         'file_name': '重命名备份文件名，不包含后缀【可选】',
-        'exclude_path_list': '文件夹排除项列表，相对路径',
-        'exclude_file_list': '排除文件列表（也会匹配文件夹），根据正则表达式匹配',
-        'last_backup_time': '上次备份时间，不要修改',
-        'fail_count': '备份失败次数，超过五次之后就不尝试备份了，不要修改'
+        'full_backup_interval': '增量备份时，每隔多少次增量强制进行一次全量备份，默认7【可选】',
+        'incremental_hash': '增量备份时是否计算文件哈希，可以跳过只改了修改时间的文件，但会增加读取量，默认false【可选】',
+        'reflink': '目标文件系统是btrfs、XFS等支持reflink的文件系统时，用reflink克隆文件，几乎不占时间和空间，默认true【可选】',
+        'verify': '备份时是否同时计算每个文件的哈希并保存校验文件，之后可以用--verify检查备份是否损坏。开启后复制不再使用reflink等内核复制方式，默认false【可选】',
+        'checksum_algorithm': '校验算法：blake2b, xxh3（更快，需要额外安装xxhash），默认blake2b【可选】',
+        'read_limit': '读取源文件的速度上限，单位MB/秒，0表示不限制，默认0。限速时复制不再使用reflink等内核复制方式【可选】',
+        'write_limit': '写入备份的速度上限，单位MB/秒，0表示不限制，默认0【可选】',
+        'nice': '备份时的CPU优先级（nice值，0-19，越大越低），0表示不调整，默认0【可选】',
+        'ionice_class': '备份时的I/O优先级：best-effort（普通）, idle（只在磁盘空闲时读写），不填表示不调整（仅Linux）【可选】',
+        'ionice_level': 'ionice_class为best-effort时的等级，0-7，越大越低，默认4【可选】',
+        'max_workers': '这个备份项最多使用多少个线程或进程（复制、扫描、压缩），0表示不限制，默认0【可选】',
+        'profile': '是否用cProfile分析这个备份项的性能，结果保存为.prof文件（在metrics_path下，未设置时在logs下），默认false【可选】',
+        'scan_index': '增量备份时是否记录文件夹索引，修改时间没变的文件夹直接跳过。文件被原地修改时文件夹的修改时间不会变，只适合文件都是整体替换写入的目录，默认false【可选】',
+        'exclude_path_list': '排除项列表，相对源目录的路径，会排除这个路径以及它下面的所有内容',
+        'exclude_file_list': '排除文件列表（也会匹配文件夹），根据正则表达式从开头匹配文件名或相对路径（用/分隔）',
     }
 }
 
@@ -59,8 +113,18 @@ def create_default_config():
             'global_method': 'copy',
             'global_predefine_patterns': 'all',
             'wakeup_frequency': 7200,
-            'zip_chunk_size': 1024 * 1024 * 500,
+            'zip_chunk_size': 1024 * 1024,
+            'zip_workers': 0,
+            'scan_workers': 4,
+            'copy_workers': 8,
+            'verify_workers': 4,
+            'max_concurrent_sections': 4,
+            'device_concurrency': 1,
+            'max_load': 0,
+            'max_iowait': 0,
             'log_level': 'INFO',
+            'metrics_path': '',
+            'metrics_format': 'jsonl',
             'exception_notification_path' : '',
         },
         'example': {
@@ -70,6 +134,22 @@ def create_default_config():
             'backup_frequency': 'daily',
             'predefine_patterns': 'all',
             'file_name': 'newname',
+            'compression': 'deflate',
+            'compression_level': 6,
+            'store_incompressible': True,
+            'full_backup_interval': 7,
+            'incremental_hash': False,
+            'scan_index': False,
+            'reflink': True,
+            'verify': False,
+            'checksum_algorithm': 'blake2b',
+            'read_limit': 0,
+            'write_limit': 0,
+            'nice': 0,
+            'ionice_class': '',
+            'ionice_level': 4,
+            'max_workers': 0,
+            'profile': False,
             # 排除项，相对路径
             'exclude_path_list': [
                 '/relative/path/to/exclude',
@@ -80,8 +160,6 @@ def create_default_config():
                 '.*\.log$',
                 '.*\.txt$',
             ],
-            'last_backup_time': 'current_time',
-            'fail_count': 0
         }
     }
 
@@ -112,15 +190,33 @@ def check_config(config):
         if 'global_method' not in config['common'].keys():
             logger.warning('配置文件中缺少common.global_method配置项，将使用默认值copy。备份方法可选值：copy（复制）, zip（压缩）等')
             config['common']['global_method'] = 'copy'
-            save_config(config)
         if 'global_predefine_patterns' not in config['common'].keys():
             logger.warning('配置文件中缺少common.global_predefine_patterns配置项，将使用默认值all。预定义备份模式可选值：all（所有）, none（无）')
             config['common']['global_predefine_patterns'] = 'all'
-            save_config(config)
         if 'zip_chunk_size' not in config['common'].keys():
-            logger.warning('配置文件中缺少common.zip_chunk_size配置项，将使用默认值500MB。')
-            config['common']['zip_chunk_size'] = 1024 * 1024 * 500
-            save_config(config)
+            logger.warning('配置文件中缺少common.zip_chunk_size配置项，将使用默认值1MB。')
+            config['common']['zip_chunk_size'] = 1024 * 1024
+        if 'zip_workers' not in config['common'].keys():
+            logger.warning('配置文件中缺少common.zip_workers配置项，将使用默认值0（使用全部CPU核心）。')
+            config['common']['zip_workers'] = 0
+        if not isinstance(config['common']['zip_workers'], int) or config['common']['zip_workers'] < 0:
+            logger.error('配置文件中common.zip_workers配置项的值不符合规范，应为非负整数')
+            raise Exception('配置文件中common.zip_workers配置项的值不符合规范，应为非负整数')
+        for key, default in (('scan_workers', SCAN_WORKERS), ('copy_workers', COPY_WORKERS), ('verify_workers', VERIFY_WORKERS), ('max_concurrent_sections', MAX_CONCURRENT_SECTIONS), ('device_concurrency', DEVICE_CONCURRENCY)):
+            if key not in config['common'].keys():
+                logger.warning(f'配置文件中缺少common.{key}配置项，将使用默认值{default}。')
+                config['common'][key] = default
+            if not isinstance(config['common'][key], int) or config['common'][key] < 1:
+                logger.error(f'配置文件中common.{key}配置项的值不符合规范，应为正整数')
+                raise Exception(f'配置文件中common.{key}配置项的值不符合规范，应为正整数')
+        for key in ('max_load', 'max_iowait'):
+            value = config['common'].get(key, 0)
+            if isinstance(value, bool) or not isinstance(value, (int, float)) or value < 0:
+                logger.error(f'配置文件中common.{key}配置项的值不符合规范，应为非负数')
+                raise Exception(f'配置文件中common.{key}配置项的值不符合规范，应为非负数')
+        if config['common'].get('metrics_format', METRICS_FORMAT) not in METRICS_FORMATS:
+            logger.error(f'配置文件中common.metrics_format配置项的值不符合规范，应为{", ".join(METRICS_FORMATS)}中的一个')
+            raise Exception(f'配置文件中common.metrics_format配置项的值不符合规范，应为{", ".join(METRICS_FORMATS)}中的一个')
 
         
         # 如果全局备份频率不属于预定义的频率，或不是一个大于wakeup_frequency的数字，则抛出异常
@@ -134,12 +230,12 @@ def check_config(config):
                 raise Exception('配置文件中common.global_frequency配置项的值不符合规范，应大于wakeup_frequency')
         
         # 如果全局备份方法不属于预定义的方法，则抛出异常
-        if config['common']['global_method'] not in ['copy', 'zip']:
-            logger.error('配置文件中common.global_method配置项的值不符合规范，应为copy（复制）, zip（压缩）等预定义的方法')
-            raise Exception('配置文件中common.global_method配置项的值不符合规范，应为copy（复制）, zip（压缩）等预定义的方法')
+        if config['common']['global_method'] not in BACKUP_METHODS:
+            logger.error('配置文件中common.global_method配置项的值不符合规范，应为copy（复制）, zip（压缩）, tar（打包压缩）, incremental（增量）, snapshot（硬链接快照）等预定义的方法')
+            raise Exception('配置文件中common.global_method配置项的值不符合规范，应为copy（复制）, zip（压缩）, tar（打包压缩）, incremental（增量）, snapshot（硬链接快照）等预定义的方法')
         
         # 如果全局预定义备份模式不属于预定义的模式，则抛出异常
-        if config['common']['global_predefine_patterns'] not in ['all', 'none', 'server_world_only', 'mcdr_server_world_only']:
+        if config['common']['global_predefine_patterns'] not in PREDEFINE_PATTERNS:
             logger.error('配置文件中common.global_predefine_patterns配置项的值不符合规范，应为all（所有）, none（无）, server_world_only（仅服务器存档）, mcdr_server_world_only（仅MCDR服务器存档）等预定义的模式')
             raise Exception('配置文件中common.global_predefine_patterns配置项的值不符合规范，应为all（所有）, none（无）, server_world_only（仅服务器存档）, mcdr_server_world_only（仅MCDR服务器存档）等预定义的模式')
         
@@ -150,14 +246,59 @@ def check_config(config):
                 if 'source_directory' not in config[section].keys():
                     logger.error(f'配置文件中缺少{section}.source_directory配置项')
                     raise Exception(f'配置文件中缺少{section}.source_directory配置项')
+                if config[section].get('predefine_patterns', config['common']['global_predefine_patterns']) not in PREDEFINE_PATTERNS:
+                    logger.error(f'配置文件中{section}.predefine_patterns配置项的值不符合规范，应为{", ".join(PREDEFINE_PATTERNS)}中的一个')
+                    raise Exception(f'配置文件中{section}.predefine_patterns配置项的值不符合规范，应为{", ".join(PREDEFINE_PATTERNS)}中的一个')
+                if config[section].get('backup_method', config['common']['global_method']) not in BACKUP_METHODS:
+                    logger.error(f'配置文件中{section}.backup_method配置项的值不符合规范，应为{", ".join(BACKUP_METHODS)}中的一个')
+                    raise Exception(f'配置文件中{section}.backup_method配置项的值不符合规范，应为{", ".join(BACKUP_METHODS)}中的一个')
+                for pattern in config[section].get('exclude_file_list', []) or []:
+                    try:
+                        re.compile(pattern)
+                    except re.error as e:
+                        logger.error(f'配置文件中{section}.exclude_file_list中的正则表达式{pattern}不合法：{str(e)}')
+                        raise Exception(f'配置文件中{section}.exclude_file_list中的正则表达式{pattern}不合法：{str(e)}')
+                backup_method = config[section].get('backup_method', config['common']['global_method'])
+                if backup_method in DEFAULT_CODECS:
+                    error = check_codec(backup_method, config[section].get('compression', DEFAULT_CODECS[backup_method]),
+                                        config[section].get('compression_level'))
+                    if error:
+                        logger.error(f'配置文件中{section}的压缩设置不符合规范：{error}')
+                        raise Exception(f'配置文件中{section}的压缩设置不符合规范：{error}')
+                compression_threads = config[section].get('compression_threads', 0)
+                if not isinstance(compression_threads, int) or compression_threads < -1:
+                    logger.error(f'配置文件中{section}.compression_threads配置项的值不符合规范，应为-1或非负整数')
+                    raise Exception(f'配置文件中{section}.compression_threads配置项的值不符合规范，应为-1或非负整数')
+                full_backup_interval = config[section].get('full_backup_interval', FULL_BACKUP_INTERVAL)
+                if not isinstance(full_backup_interval, int) or full_backup_interval < 0:
+                    logger.error(f'配置文件中{section}.full_backup_interval配置项的值不符合规范，应为非负整数')
+                    raise Exception(f'配置文件中{section}.full_backup_interval配置项的值不符合规范，应为非负整数')
+                for key in ('read_limit', 'write_limit'):
+                    value = config[section].get(key, 0)
+                    if isinstance(value, bool) or not isinstance(value, (int, float)) or value < 0:
+                        logger.error(f'配置文件中{section}.{key}配置项的值不符合规范，应为非负数（MB/秒）')
+                        raise Exception(f'配置文件中{section}.{key}配置项的值不符合规范，应为非负数（MB/秒）')
+                for key, low, high in (('nice', 0, 19), ('ionice_level', 0, 7), ('max_workers', 0, None)):
+                    value = config[section].get(key, 0)
+                    if not isinstance(value, int) or value < low or (high is not None and value > high):
+                        expected = f'{low}到{high}之间的整数' if high is not None else '非负整数'
+                        logger.error(f'配置文件中{section}.{key}配置项的值不符合规范，应为{expected}')
+                        raise Exception(f'配置文件中{section}.{key}配置项的值不符合规范，应为{expected}')
+                if (config[section].get('ionice_class') or '') not in IONICE_CLASSES:
+                    logger.error(f'配置文件中{section}.ionice_class配置项的值不符合规范，应为best-effort或idle，不填表示不调整')
+                    raise Exception(f'配置文件中{section}.ionice_class配置项的值不符合规范，应为best-effort或idle，不填表示不调整')
+                if config[section].get('verify', False):
+                    error = check_checksum_algorithm(config[section].get('checksum_algorithm', 'blake2b'))
+                    if error:
+                        logger.error(f'配置文件中{section}的校验设置不符合规范：{error}')
+                        raise Exception(f'配置文件中{section}的校验设置不符合规范：{error}')
     
     except Exception as e:
-        if EXECEPTION_NOTIFICATION_PATH != '':
-            # 把当前日志复制到EXECEPTION_NOTIFICATION_PATH/error.log，如果没有则创建
+        if EXECEPTION_NOTIFICATION_PATH:
+            # 把错误信息写到EXECEPTION_NOTIFICATION_PATH/error.log，如果没有则创建
             os.makedirs(EXECEPTION_NOTIFICATION_PATH, exist_ok=True)
             with open(os.path.join(EXECEPTION_NOTIFICATION_PATH, 'error.log'), 'w', encoding='utf-8') as file:
-                with open('log.log', 'r', encoding='utf-8') as log:
-                    file.write(f'[{time.strftime("%Y-%m-%d %H:%M:%S", time.localtime())}] {str(e)}\n')
+                file.write(f'[{time.strftime("%Y-%m-%d %H:%M:%S", time.localtime())}] {str(e)}\n')
 
 
 # 读取配置文件
@@ -175,7 +316,10 @@ def load_config(file_path):
     return config
 
 # 确认是否备份文件
-def backup_confirm(config, section):
+# tolerance是提前量：一次性运行时按唤醒间隔的1/4提前备份，避免因为唤醒时间的误差错过一整个周期；常驻模式下为0
+def backup_confirm(config, section, tolerance=None):
+    if tolerance is None:
+        tolerance = WAKEUP_FREQUENCY/4
     # 如果是全局或示例配置，则跳过
     if section == 'common' or section == 'example':
         return False
@@ -195,7 +339,7 @@ def backup_confirm(config, section):
     if not isinstance(backup_frequency, int):
         backup_frequency = freq_dict.get(backup_frequency, 86400)
     # 如果上次备份时间距离现在的时间小于备份频率，则跳过
-    if (datetime.now() - datetime.strptime(last_backup_time, "%Y-%m-%d %H:%M:%S")).total_seconds() < backup_frequency - WAKEUP_FREQUENCY/4: 
+    if (datetime.now() - datetime.strptime(last_backup_time, "%Y-%m-%d %H:%M:%S")).total_seconds() < backup_frequency - tolerance: 
         return False
     
     # 如果已经备份失败超过五次，强制启用两日一备份，避免因为备份间隔太快导致的硬盘爆满
@@ -203,9 +347,10 @@ def backup_confirm(config, section):
         logger.warning(f'检测到{section}已经备份失败超过五次！')
         if backup_frequency < 2*86400:
             logger.warning(f'目前的备份频率过高，为防止因为备份间隔太快导致的硬盘爆满，将强制启用两日一备份！')
-            if (datetime.now() - datetime.strptime(last_backup_time, "%Y-%m-%d %H:%M:%S")).total_seconds() < 2*86400 - WAKEUP_FREQUENCY/4: 
+            if (datetime.now() - datetime.strptime(last_backup_time, "%Y-%m-%d %H:%M:%S")).total_seconds() < 2*86400 - tolerance: 
                 # 直接更新备份时间
                 config[section]['last_backup_time'] = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime())
+                save_state(config, section)
                 return False
         
 
@@ -213,6 +358,36 @@ def backup_confirm(config, section):
     return True
 
 
+# 计算备份项的逾期程度（距离上次备份的时间 / 备份频率），用于决定多个备份项的执行顺序
+def overdue_ratio(config, section):
+    last_backup_time = config[section].get('last_backup_time', '')
+    if last_backup_time == '':
+        return float('inf')
+    backup_frequency = config[section].get('backup_frequency', GLOBAL_FREQUENCY)
+    if not isinstance(backup_frequency, int):
+        backup_frequency = freq_dict.get(backup_frequency, 86400)
+    elapsed = (datetime.now() - datetime.strptime(last_backup_time, "%Y-%m-%d %H:%M:%S")).total_seconds()
+    return elapsed / max(backup_frequency, 1)
+
+
+# 并发执行需要备份的备份项
+# 每个备份项在自己的线程里操作配置的副本，完成后由主线程合并回config并保存运行状态，避免多线程同时修改config
+def run_sections(config, sections):
+    def make_job(section):
+        def func():
+            return backup_files({section: dict(config[section])}, section)[section]
+        return SectionJob(section, overdue_ratio(config, section),
+                          config[section].get('source_directory'),
+                          config[section].get('destination_directory', GLOBAL_DESTINATION), func)
+
+    def on_done(job, section_config):
+        config[job.name] = section_config
+        save_state(config, job.name)
+
+    run_jobs([make_job(section) for section in sections], MAX_CONCURRENT_SECTIONS, DEVICE_CONCURRENCY, on_done)
+    return config
+
+
 # 备份文件
 def backup_files(config, section):
     # 如果上次备份时间为空，则跳过并且更新上次备份时间为今天
@@ -230,8 +405,67 @@ def backup_files(config, section):
     exclude_path_list = config[section].get('exclude_path_list', [])
     exclude_file_list = config[section].get('exclude_file_list', [])
 
-    task = BackupTask(source_dir, destination_dir, backup_method, predefine_patterns, exclude_path_list, exclude_file_list, file_name)
-    if task.backup_files():#备份成功更新时间
+    full_backup_interval = config[section].get('full_backup_interval', FULL_BACKUP_INTERVAL)
+    incremental_hash = config[section].get('incremental_hash', False)
+
+    compression = config[section].get('compression')
+    compression_level = config[section].get('compression_level')
+    compression_threads = config[section].get('compression_threads', 0)
+    store_incompressible = config[section].get('store_incompressible', True)
+    scan_index = config[section].get('scan_index', False)
+    reflink = config[section].get('reflink', True)
+    verify = config[section].get('verify', False)
+    checksum_algorithm = config[section].get('checksum_algorithm', 'blake2b')
+    read_limit = config[section].get('read_limit', 0)
+    write_limit = config[section].get('write_limit', 0)
+    nice = config[section].get('nice', 0)
+    ionice_class = config[section].get('ionice_class') or ''
+    ionice_level = config[section].get('ionice_level', 4)
+
+    # 每个备份项可以单独限制线程数、进程数，避免大的备份项占满CPU
+    max_workers = config[section].get('max_workers', 0)
+    zip_workers, scan_workers, copy_workers = ZIP_WORKERS, SCAN_WORKERS, COPY_WORKERS
+    if max_workers:
+        zip_workers, scan_workers, copy_workers = min(zip_workers, max_workers), min(scan_workers, max_workers), min(copy_workers, max_workers)
+        if compression_threads == -1 or compression_threads > max_workers:
+            compression_threads = max_workers
+
+    start_time = time.time()
+    start_str = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(start_time))
+    task = None
+    metrics = RunMetrics()
+    # 备份先写到临时名字，只有重命名成最终名字之后才返回成功，所以上次备份时间不会指向不完整的备份
+    def run_task():
+        if config[section].get('profile', False):
+            profile_dir = METRICS_PATH or 'logs'
+            with profile_run(os.path.join(profile_dir, f'profile_{section}_{time.strftime("%Y-%m-%d_%H-%M-%S", time.localtime(start_time))}.prof')):
+                return task.backup_files()
+        return task.backup_files()
+
+    # 设置了nice或ionice时在单独的低优先级线程里备份，复制线程和压缩子进程都会继承这个优先级
+    # 创建备份任务或备份过程中抛出的异常也按失败处理，照常记录失败次数、运行历史和指标
+    try:
+        task = BackupTask(source_dir, destination_dir, backup_method, predefine_patterns, exclude_path_list, exclude_file_list, file_name,
+                          full_backup_interval=full_backup_interval, incremental_hash=incremental_hash, zip_workers=zip_workers,
+                          zip_chunk_size=ZIP_CHUNK_SIZE, compression=compression, compression_level=compression_level,
+                          compression_threads=compression_threads, store_incompressible=store_incompressible,
+                          scan_workers=scan_workers, scan_index=scan_index, copy_workers=copy_workers, reflink=reflink,
+                          verify=verify, checksum_algorithm=checksum_algorithm,
+                          read_limit=int(read_limit * 1024 * 1024), write_limit=int(write_limit * 1024 * 1024),
+                          max_load=MAX_LOAD, max_iowait=MAX_IOWAIT, exception_notification_path=EXECEPTION_NOTIFICATION_PATH,
+                          section=section)
+        metrics = task.metrics
+        success = run_with_priority(run_task, nice, ionice_class, ionice_level)
+    except Exception as e:
+        logger.error(f'备份{section}时出错：{str(e)}')
+        success = False
+    stats = task.stats if task is not None else {}
+    if task is not None and task.throttle is not None and task.throttle.paused:
+        logger.info(f'{section}因为系统繁忙累计暂停了{task.throttle.paused:.0f}秒')
+    STATE_STORE.record_run(section, backup_method, start_str, time.time() - start_time, success, stats)
+    if METRICS_PATH:
+        write_metrics(METRICS_PATH, METRICS_FORMAT, metrics.to_record(section, backup_method, start_str, success, stats))
+    if success:#备份成功更新时间
         logger.info(f'更新上次备份时间为当前时间')
         config[section]['last_backup_time'] = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime())
         if config[section].get('fail_count', 0) > 0:
@@ -253,6 +487,13 @@ def backup_files(config, section):
     return config
 
 
+# 保存一个备份项的运行状态，只写一行，不改写配置文件
+def save_state(config, section):
+    logger.info(f'保存{section}的运行状态')
+    STATE_STORE.save(section, config[section].get('last_backup_time', ''), config[section].get('fail_count', 0))
+
+
+# 只在创建默认配置文件时使用，之后配置文件只由用户修改
 def save_config(config, comments):
     with open(CONFIG_FILE, 'w',encoding='utf-8') as file:
         file.write('# common是全局配置，必须设置，如果后面的task缺少设置项，会默认全局配置\n')
@@ -273,25 +514,26 @@ def save_config(config, comments):
                     file.write(f'  {key}: {value}\n')
 
 
-# 运行备份
-def run_backup():
-
-    # 载入全局配置
+# 载入全局配置
+def apply_common_config(config):
     global GLOBAL_DESTINATION
     global GLOBAL_FREQUENCY
     global GLOBAL_METHOD
     global GLOBAL_PREDEFINE_PATTERNS
     global WAKEUP_FREQUENCY
     global ZIP_CHUNK_SIZE
+    global ZIP_WORKERS
+    global SCAN_WORKERS
+    global COPY_WORKERS
+    global VERIFY_WORKERS
+    global MAX_CONCURRENT_SECTIONS
+    global DEVICE_CONCURRENCY
+    global METRICS_PATH
+    global METRICS_FORMAT
+    global MAX_LOAD
+    global MAX_IOWAIT
     global EXECEPTION_NOTIFICATION_PATH
     global LOG_LEVEL
-    global CONFIG_FILE
-
-    logger.info('启动备份程序，开始读取配置文件：')
-    # 读取配置文件
-    config = load_config(CONFIG_FILE)
-
-
 
     GLOBAL_DESTINATION = config['common']['global_destination']
     GLOBAL_FREQUENCY = config['common']['global_frequency']
@@ -299,21 +541,158 @@ def run_backup():
     GLOBAL_PREDEFINE_PATTERNS = config['common']['global_predefine_patterns']
     WAKEUP_FREQUENCY = config['common']['wakeup_frequency']
     ZIP_CHUNK_SIZE = config['common']['zip_chunk_size']
-    EXECEPTION_NOTIFICATION_PATH = config['common']['exception_notification_path']
+    ZIP_WORKERS = config['common'].get('zip_workers', ZIP_WORKERS) or os.cpu_count() or 1
+    SCAN_WORKERS = config['common'].get('scan_workers', SCAN_WORKERS)
+    COPY_WORKERS = config['common'].get('copy_workers', COPY_WORKERS)
+    VERIFY_WORKERS = config['common'].get('verify_workers', VERIFY_WORKERS)
+    MAX_CONCURRENT_SECTIONS = config['common'].get('max_concurrent_sections', MAX_CONCURRENT_SECTIONS)
+    DEVICE_CONCURRENCY = config['common'].get('device_concurrency', DEVICE_CONCURRENCY)
+    METRICS_PATH = config['common'].get('metrics_path', METRICS_PATH) or ''
+    METRICS_FORMAT = config['common'].get('metrics_format', METRICS_FORMAT)
+    MAX_LOAD = config['common'].get('max_load', MAX_LOAD) or 0
+    MAX_IOWAIT = config['common'].get('max_iowait', MAX_IOWAIT) or 0
+    EXECEPTION_NOTIFICATION_PATH = config['common'].get('exception_notification_path') or ''
     LOG_LEVEL = config['common'].get('log_level')
+    set_log_level(LOG_LEVEL)
+
+
+# 打开运行状态数据库
+def open_state_store():
+    global STATE_STORE
+    if STATE_STORE is None:
+        STATE_STORE = StateStore(STATE_FILE)
+    return STATE_STORE
+
 
+# 运行备份
+def run_backup():
+    logger.info('启动备份程序，开始读取配置文件：')
+    # 读取配置文件，再合并数据库里的运行状态
+    config = load_config(CONFIG_FILE)
+    apply_common_config(config)
+    open_state_store().apply(config)
 
     logger.info(config)
-    # 备份文件
-    for section in config.keys():
-        if backup_confirm(config, section):
-            config = backup_files(config, section)
-            logger.info('更新到配置文件')
-            save_config(config)
+    # 先依次确认哪些备份项需要备份，再并发执行
+    sections = [section for section in config.keys() if backup_confirm(config, section)]
+    config = run_sections(config, sections)
     
     logger.info(f'执行了所有备份任务，{WAKEUP_FREQUENCY}秒后再见！')
 
 
+# 校验所有备份项已有的备份，全部完好时返回True
+def run_verify():
+    logger.info('开始校验所有备份项的备份：')
+    config = load_config(CONFIG_FILE)
+    apply_common_config(config)
+    ok = True
+    for section in config.keys():
+        if section == 'common' or section == 'example':
+            continue
+        source_dir = config[section].get('source_directory')
+        destination_dir = config[section].get('destination_directory', GLOBAL_DESTINATION)
+        file_name = config[section].get('file_name', os.path.basename(source_dir))
+        if not verify_section(destination_dir, file_name, VERIFY_WORKERS):
+            ok = False
+    if ok:
+        logger.info('校验完成，所有备份完好')
+    else:
+        logger.error('校验完成，有备份损坏或缺失，请查看上面的日志')
+    return ok
+
+
+# 计算备份项下一次需要备份的时间戳，不需要备份的返回None
+def next_due_time(config, section):
+    if section == 'common' or section == 'example':
+        return None
+    if config[section].get('predefine_patterns', GLOBAL_PREDEFINE_PATTERNS) == 'none':
+        return None
+    last_backup_time = config[section].get('last_backup_time', '')
+    if last_backup_time == '':
+        return time.time()
+    backup_frequency = config[section].get('backup_frequency', GLOBAL_FREQUENCY)
+    if not isinstance(backup_frequency, int):
+        backup_frequency = freq_dict.get(backup_frequency, 86400)
+    # 失败五次以上时，backup_confirm会强制两日一备份
+    if config[section].get('fail_count', 0) >= 5:
+        backup_frequency = max(backup_frequency, 2*86400)
+    return datetime.strptime(last_backup_time, "%Y-%m-%d %H:%M:%S").timestamp() + backup_frequency
+
+
+# 按下一次备份时间建立小根堆
+def build_schedule(config):
+    schedule = []
+    for section in config.keys():
+        due = next_due_time(config, section)
+        if due is not None:
+            schedule.append((due, section))
+    heapq.heapify(schedule)
+    return schedule
+
+
+# 常驻运行：配置只在文件被修改时重新读取，每次睡眠到最近一个备份项到期（或到了检查配置文件的时间）
+def run_daemon():
+    logger.info('以常驻模式启动备份程序，开始读取配置文件：')
+    config = load_config(CONFIG_FILE)
+    apply_common_config(config)
+    open_state_store().apply(config)
+    config_mtime = os.path.getmtime(CONFIG_FILE)
+    schedule = build_schedule(config)
+
+    while True:
+        # 取出所有已经到期的备份项，是否真的需要备份仍然由backup_confirm决定
+        now = time.time()
+        due_sections = []
+        while schedule and schedule[0][0] <= now:
+            due_sections.append(heapq.heappop(schedule)[1])
+        if due_sections:
+            sections = [section for section in due_sections if backup_confirm(config, section, tolerance=0)]
+            config = run_sections(config, sections)
+            for section in due_sections:
+                due = next_due_time(config, section)
+                if due is None:
+                    continue
+                # 备份失败时上次备份时间不会更新，等一个唤醒间隔后再重试，避免连续失败时空转
+                if due <= time.time():
+                    due = time.time() + WAKEUP_FREQUENCY
+                heapq.heappush(schedule, (due, section))
+
+        if schedule:
+            next_section = schedule[0][1]
+            sleep_time = schedule[0][0] - time.time()
+            logger.info(f'下一个备份项{next_section}将在{max(0, int(sleep_time))}秒后到期')
+        else:
+            sleep_time = CONFIG_POLL_INTERVAL
+        # 分段睡眠，期间检查配置文件是否被修改
+        deadline = time.time() + sleep_time
+        while time.time() < deadline:
+            time.sleep(max(0, min(CONFIG_POLL_INTERVAL, deadline - time.time())))
+            try:
+                mtime = os.path.getmtime(CONFIG_FILE)
+            except OSError:
+                continue
+            if mtime != config_mtime:
+                logger.info('检测到配置文件被修改，重新读取配置文件')
+                try:
+                    config = load_config(CONFIG_FILE)
+                    apply_common_config(config)
+                    STATE_STORE.apply(config)
+                    schedule = build_schedule(config)
+                except Exception as e:
+                    logger.error(f'重新读取配置文件失败，继续使用原来的配置。错误信息：{str(e)}')
+                config_mtime = mtime
+                break
+
+
 if __name__ == '__main__':
-    
-    run_backup()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description='自动备份程序')
+    parser.add_argument('--daemon', action='store_true', help='常驻运行，按照各备份项的下一次备份时间自动唤醒，不再需要外部定时任务')
+    parser.add_argument('--verify', action='store_true', help='根据校验文件检查所有备份项已有的备份是否损坏，有损坏时返回1')
+    args = parser.parse_args()
+
+    if args.verify:
+        sys.exit(0 if run_verify() else 1)
+    elif args.daemon:
+        run_daemon()
+    else:
+        run_backup()
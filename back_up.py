@@ -1,14 +1,32 @@
 import re
 import os
+import zlib
 import shutil
 import time
 import zipfile
-import concurrent.futures
 from logger_config import logger
-global ZIP_CHUNK_SIZE, EXECEPTION_NOTIFICATION_PATH
+from manifest import manifest_path, dir_index_path, load_manifest, save_manifest, check_file_state
+from scanner import ScanEntry, DirIndex, scan_tree
+from copier import ParallelCopier, remove_existing
+from journal import PARTIAL_SUFFIX, Journal, journal_path, unique_name, load_journal, commit_partial, fsync_tree, fsync_file, zipinfo_to_record, zipinfo_from_record
+from parallel_zip import write_parallel, zipinfo_from_entry
+from exclusion import ExclusionMatcher
+from metrics import RunMetrics
+from checksum import CHECKSUM_FILE, CHECKSUM_BLOCK_SIZE, TreeHasher, HashingReader, hash_file, save_checksums, load_checksums
+from index import SnapshotIndex, index_path, zipinfo_entry
+from throttle import Throttle
+from worlds import WORLD_PATTERNS, WORLD_MARKER, find_worlds, is_region_file, same_region
+from compression import ZIP_CODECS, TAR_CODECS, DEFAULT_CODECS, is_incompressible, open_tar, tarinfo_from_entry
+
+STREAM_BUFFER_SIZE = 1024 * 1024  # 流式压缩的读取缓冲区大小，1MB
+MAX_STREAM_BUFFER_SIZE = 1024 * 1024 * 64  # 读取缓冲区大小的上限，64MB
 
 class BackupTask:
-    def __init__(self, source_dir, destination_dir, backup_method, predefine_patterns, exclude_path_list, exclude_file_list, file_name):
+    def __init__(self, source_dir, destination_dir, backup_method, predefine_patterns, exclude_path_list, exclude_file_list, file_name,
+                 full_backup_interval=7, incremental_hash=False, zip_workers=1, zip_chunk_size=STREAM_BUFFER_SIZE,
+                 compression=None, compression_level=None, compression_threads=0, store_incompressible=True,
+                 scan_workers=1, scan_index=False, copy_workers=1, reflink=True, verify=False, checksum_algorithm='blake2b',
+                 read_limit=0, write_limit=0, max_load=0, max_iowait=0, exception_notification_path='', section=''):
         self.source_dir = source_dir
         self.destination_dir = destination_dir
         self.backup_method = backup_method
@@ -16,6 +34,35 @@ class BackupTask:
         self.exclude_path_list = exclude_path_list
         self.exclude_file_list = exclude_file_list
         self.file_name = file_name
+        self.section = section  # 配置文件里的备份项名称，用来区分file_name相同的备份项的检查点日志
+        self.matcher = ExclusionMatcher(exclude_path_list, exclude_file_list)
+        self.full_backup_interval = full_backup_interval  # 增量备份每隔多少次强制全量备份一次
+        self.incremental_hash = incremental_hash  # 增量备份时是否用内容哈希辅助判断文件是否变化
+        self.zip_workers = zip_workers  # zip并行压缩的进程数，1表示不并行
+        # 压缩时的读取缓冲区大小，旧配置里的500MB会被限制到MAX_STREAM_BUFFER_SIZE
+        self.zip_chunk_size = max(4096, min(zip_chunk_size, MAX_STREAM_BUFFER_SIZE))
+        self.compression = compression or DEFAULT_CODECS.get(backup_method, 'deflate')  # 压缩算法
+        self.compression_level = compression_level  # 压缩等级，None表示使用算法的默认等级
+        self.compression_threads = compression_threads  # zstd的压缩线程数，0表示单线程，-1表示全部CPU核心
+        self.store_incompressible = store_incompressible  # zip中是否直接存储不可压缩的文件
+        self.scan_workers = scan_workers  # 扫描源目录的线程数
+        self.scan_index = scan_index  # 增量备份时是否用文件夹索引跳过没有变化的文件夹
+        self.dir_index = None
+        self.copy_workers = copy_workers  # 同时复制文件的线程数
+        self.reflink = reflink  # 目标文件系统支持时（btrfs、XFS等），是否用reflink克隆文件
+        # 开启校验时，备份的同时计算每个文件的哈希并保存校验文件，可以用--verify检查备份是否损坏
+        self.checksum = checksum_algorithm if verify else None
+        self.checksums = {}  # 相对路径 -> 哈希
+        self.index_entries = {}  # 这次备份里的文件：相对路径 -> (大小, 修改时间)，备份完成后写入快照索引
+        # 读写限速（字节/秒）和系统繁忙时暂停，都不需要时为None
+        self.throttle = Throttle(read_limit, write_limit, max_load, max_iowait) if read_limit or write_limit or max_load or max_iowait else None
+        self.exception_notification_path = exception_notification_path  # 压缩失败时把错误信息写到这个目录下的error.log，为空时不写
+        self.world_dirs = None  # 只备份存档时，存档相对源目录的路径
+        self.region_check = False  # 是否用区域文件头的区块保存时间判断区域文件是否变化
+        self.created_dirs = set()
+        self.journal = None  # 检查点日志，用于中断后继续备份
+        self.stats = {'files': 0, 'bytes_written': 0, 'bytes_skipped': 0, 'bytes_resumed': 0}
+        self.metrics = RunMetrics()  # 各阶段耗时、读写量、最慢的文件等指标
 
     def copy_file(self):
         try:
@@ -24,94 +71,489 @@ class BackupTask:
             logger.info(f'开始备份：{self.source_dir} -> {self.destination_dir}，目标文件名：{self.file_name}')
             start_time = time.time()
 
-            # 定义ignore函数用于过滤需要排除的文件或文件夹
-            def ignore_func(dir, files):
-                ignored = set()
-                if self.exclude_path_list:
-                    ignored.update(item for item in files if os.path.isdir(os.path.join(dir, item)) and item in self.exclude_path_list)
-                if self.exclude_file_list:
-                    pattern = re.compile('|'.join(self.exclude_file_list))
-                    ignored.update(item for item in files if pattern.match(item))
-                return ignored
-
-            # 如果是文件，使用shutil.copy
+            # 先写到临时名字，全部完成后再重命名，中途中断不会留下看起来完整的备份
+            # 如果是文件，直接复制
             if os.path.isfile(self.source_dir):
-                shutil.copy(self.source_dir, self.destination_dir + '/' + self.file_name + '_' + time.strftime("%Y-%m-%d_%H-%M-%S", time.localtime()) + os.path.splitext(self.source_dir)[1])
-            # 如果是文件夹，使用shutil.copytree
+                final_name = self.file_name + '_' + time.strftime("%Y-%m-%d_%H-%M-%S", time.localtime()) + os.path.splitext(self.source_dir)[1]
+                header, partial_path, _ = self.begin_partial(final_name, resumable=False)
+                size = os.path.getsize(self.source_dir)
+                with ParallelCopier(1, self.reflink, self.metrics, self.checksum, self.checksums, self.throttle) as copier:
+                    copier.copy(self.source_dir, partial_path, size, key=header['snapshot'])
+                self.stats['copy_strategies'] = copier.summary()
+                self.stats['files'] += 1
+                self.stats['bytes_written'] += size
+                self.commit_partial(partial_path, header['snapshot'])
+                self.write_checksums(os.path.join(self.destination_dir, header['snapshot'] + CHECKSUM_FILE))
+                self.write_index(header['snapshot'], 'file', [(os.path.basename(self.source_dir), size, os.path.getmtime(self.source_dir),
+                                                               self.checksums.get(header['snapshot']), None, None, None, None)])
+            # 如果是文件夹，边扫描边复制，被排除的文件夹不会被遍历
             else:
-                # 使用ignore参数排除指定的文件或文件夹
-                shutil.copytree(self.source_dir, self.destination_dir + '/' + self.file_name + '_' + time.strftime("%Y-%m-%d_%H-%M-%S", time.localtime()), ignore=ignore_func, dirs_exist_ok=True)
+                final_name = self.file_name + '_' + time.strftime("%Y-%m-%d_%H-%M-%S", time.localtime())
+                header, snapshot_dir, records = self.begin_partial(final_name)
+                done = {record['path']: record for record in records}
+                os.makedirs(snapshot_dir, exist_ok=True)
+                with ParallelCopier(self.copy_workers, self.reflink, self.metrics, self.checksum, self.checksums, self.throttle) as copier:
+                    for entry in self.scan_source():
+                        destination_path = os.path.join(snapshot_dir, entry.rel_path)
+                        if entry.is_dir:
+                            self.make_dir(destination_path)
+                            continue
+                        self.index_file(entry.rel_path, entry)
+                        if self.already_copied(done, entry.rel_path, entry, destination_path):
+                            self.stats['bytes_resumed'] += entry.st_size
+                            continue
+                        self.make_dir(os.path.dirname(destination_path))
+                        copier.copy(entry.path, destination_path, entry.st_size, on_done=self.journal_file(entry.rel_path, entry), key=entry.rel_path)
+                        self.stats['files'] += 1
+                        self.stats['bytes_written'] += entry.st_size
+                self.stats['copy_strategies'] = copier.summary()
+                self.write_checksums(os.path.join(snapshot_dir, CHECKSUM_FILE))
+                self.commit_partial(snapshot_dir, header['snapshot'])
+                self.write_index(header['snapshot'], 'dir')
+            self.metrics.counters['bytes_output'] = self.stats['bytes_written']
             
             end_time = time.time()
-            logger.info(f"备份完成：{self.source_dir} -> {self.destination_dir}，耗时：{end_time - start_time}秒")
+            logger.info(f"备份完成：{self.source_dir} -> {self.destination_dir}，耗时：{end_time - start_time}秒，复制方式：{self.stats['copy_strategies']}")
+        except Exception as e:
+            self.close_journal()
+            logger.error(f"备份失败：{self.source_dir} -> {self.destination_dir} 错误信息：{str(e)}")
+            return False
+        return True
+
+    # 开始写入一个备份，返回(日志头部, 临时路径, 已完成的记录)
+    # 上次同一备份方法的备份中断时，继续使用它的名字和临时文件；resumable为False时总是重新开始
+    def begin_partial(self, final_name, header=None, resumable=True):
+        path = journal_path(self.destination_dir, self.file_name, self.section)
+        old_header, records = load_journal(path)
+        if old_header:
+            old_partial = os.path.join(self.destination_dir, old_header['snapshot'] + PARTIAL_SUFFIX)
+            if resumable and old_header.get('method') == self.backup_method and os.path.exists(old_partial):
+                if not os.path.lexists(os.path.join(self.destination_dir, old_header['snapshot'])):
+                    logger.info(f'检测到上次未完成的备份{old_header["snapshot"]}，已完成{len(records)}个文件，将从中断处继续')
+                    self.journal = Journal(path, old_header, resume=True)
+                    return old_header, old_partial, records
+                # 最终名字已经被别的备份占用，继续下去也无法重命名，只能重新开始
+                logger.warning(f'上次未完成的备份{old_header["snapshot"]}的名字已经被占用，将重新开始备份')
+            # 无法继续的临时文件直接删除
+            if os.path.isdir(old_partial):
+                shutil.rmtree(old_partial)
+            elif os.path.exists(old_partial):
+                os.remove(old_partial)
+        final_name = unique_name(self.destination_dir, final_name)
+        header = dict(header or {}, method=self.backup_method, snapshot=final_name)
+        self.journal = Journal(path, header)
+        return header, os.path.join(self.destination_dir, final_name + PARTIAL_SUFFIX), []
+
+    # 备份写完后把临时名字重命名为最终名字，成功后删除检查点日志
+    def commit_partial(self, partial_path, final_name):
+        with self.metrics.phase('commit'):
+            # 硬链接、新建的文件夹等条目也要落盘，文件本身在复制时已经fsync过
+            if os.path.isdir(partial_path):
+                fsync_tree(partial_path)
+            self.journal.sync()
+            try:
+                commit_partial(partial_path, os.path.join(self.destination_dir, final_name))
+            except FileExistsError:
+                # 这个名字在备份过程中被别的备份占用了，日志和临时文件都不能再用，删掉后下次重新开始
+                self.journal.remove()
+                self.journal = None
+                if os.path.isdir(partial_path):
+                    shutil.rmtree(partial_path)
+                elif os.path.exists(partial_path):
+                    os.remove(partial_path)
+                raise
+            self.journal.remove()
+            self.journal = None
+
+    # 备份失败时关闭检查点日志，保留临时文件，下次从中断处继续
+    def close_journal(self):
+        if self.journal is not None:
+            self.journal.close()
+            self.journal = None
+
+    # 判断上次中断前是否已经完整复制了这个文件；已经复制的文件沿用日志里记录的哈希
+    def already_copied(self, done, rel_path, st, destination_path):
+        record = done.get(rel_path)
+        if record is None or record['size'] != st.st_size or record['mtime'] != st.st_mtime_ns:
+            return False
+        try:
+            if os.stat(destination_path).st_size != st.st_size:
+                return False
+        except OSError:
+            return False
+        if self.checksum:
+            self.checksums[rel_path] = record.get('checksum') or hash_file(destination_path, self.checksum)
+        return True
+
+    # 文件复制完成后记录到检查点日志
+    def journal_file(self, rel_path, st):
+        def on_done():
+            self.journal.append({'path': rel_path, 'size': st.st_size, 'mtime': st.st_mtime_ns, 'checksum': self.checksums.get(rel_path)})
+        return on_done
+
+    # 记录一个包含在这次备份里的文件（包括上次中断前已经复制的）
+    def index_file(self, rel_path, st):
+        self.index_entries[rel_path] = (st.st_size, st.st_mtime_ns / 1e9)
+
+    # 把这次备份的文件写入快照索引，顺便删掉已经不存在的备份的索引
+    # 索引只用于查找和恢复，写入失败不影响备份本身
+    def write_index(self, snapshot_name, kind, entries=None):
+        if entries is None:
+            entries = [(rel_path, size, mtime, self.checksums.get(rel_path), None, None, None, None)
+                       for rel_path, (size, mtime) in self.index_entries.items()]
+        try:
+            with self.metrics.phase('commit'), SnapshotIndex(index_path(self.destination_dir, self.file_name)) as index:
+                index.add_snapshot(snapshot_name, kind, entries)
+                index.prune(self.destination_dir)
+        except Exception as e:
+            logger.warning(f'快照索引写入失败，不影响备份本身，之后可以用restore.py --reindex重建。错误信息：{str(e)}')
+
+    # 开启校验时保存校验文件
+    def write_checksums(self, path):
+        if self.checksum:
+            with self.metrics.phase('commit'):
+                save_checksums(path, self.checksum, self.checksums)
+
+    # 创建目标文件夹，已经创建过的不再重复调用makedirs
+    def make_dir(self, path):
+        if path not in self.created_dirs:
+            os.makedirs(path, exist_ok=True)
+            self.created_dirs.add(path)
+
+    # 扫描源目录下需要备份的文件和文件夹，返回ScanEntry
+    def scan_source(self, use_index=False):
+        if os.path.isfile(self.source_dir):
+            st = os.stat(self.source_dir)
+            yield ScanEntry(self.source_dir, os.path.basename(self.source_dir), False, st.st_size, st.st_mtime_ns, st.st_ino, st.st_mode,
+                            st.st_uid, st.st_gid)
+            return
+        # 只备份存档时只扫描各个存档文件夹，相对路径仍然相对源目录
+        roots = [''] if self.world_dirs is None else self.world_dirs
+        for rel_root in roots:
+            root = os.path.join(self.source_dir, rel_root) if rel_root else self.source_dir
+            # 只统计扫描本身的耗时，不包括调用方复制或压缩每个文件的时间
+            # 复制和原来的shutil.copytree一样进入指向文件夹的符号链接，其他方式跳过这些链接
+            yield from self.metrics.timed_iter('scan', scan_tree(root, self.matcher, self.scan_workers, self.dir_index,
+                                                                 use_index, self.metrics.counters, rel_root,
+                                                                 follow_symlinks=self.backup_method == 'copy'))
+
+    # 遍历源目录下需要备份的文件，返回ScanEntry，压缩时直接使用扫描时的stat结果
+    def walk_source_files(self):
+        for entry in self.scan_source():
+            if not entry.is_dir:
+                yield entry
+
+    def incremental_file(self):
+        try:
+            logger.info(f'加载备份排除项列表：{self.exclude_path_list}')
+            logger.info(f'加载备份排除文件列表：{self.exclude_file_list}')
+            start_time = time.time()
+
+            path = manifest_path(self.destination_dir, self.file_name)
+            manifest = load_manifest(path)
+            # 没有清单（第一次备份）或增量次数达到上限时，强制全量备份
+            full = not manifest['files'] or manifest['increments'] >= self.full_backup_interval
+            snapshot_name = self.file_name + '_' + time.strftime("%Y-%m-%d_%H-%M-%S", time.localtime()) + ('_full' if full else '_incr')
+            # 继续上次中断的备份时，沿用它的名字和全量/增量类型
+            header, snapshot_dir, records = self.begin_partial(snapshot_name, {'full': full})
+            snapshot_name, full = header['snapshot'], header['full']
+            done = {record['path']: record for record in records}
+            logger.info(f'开始{"全量" if full else "增量"}备份：{self.source_dir} -> {self.destination_dir}，目标文件名：{snapshot_name}')
+
+            old_files = {} if full else manifest['files']
+            new_files = {}
+            os.makedirs(snapshot_dir, exist_ok=True)
+            # 开启文件夹索引时，修改时间没变的文件夹直接使用上次的扫描结果；全量备份时总是完整扫描一遍
+            if self.scan_index:
+                self.dir_index = DirIndex(dir_index_path(self.destination_dir, self.file_name))
+            with ParallelCopier(self.copy_workers, self.reflink, self.metrics, self.checksum, self.checksums, self.throttle) as copier:
+                for st in self.scan_source(use_index=not full):
+                    if st.is_dir:
+                        continue
+                    file_path, rel_path = st.path, st.rel_path
+                    state, changed = check_file_state(file_path, st, old_files.get(rel_path), self.incremental_hash,
+                                                      self.region_check and is_region_file(file_path))
+                    new_files[rel_path] = state
+                    if not changed:
+                        self.stats['bytes_skipped'] += st.st_size
+                        continue
+                    self.index_file(rel_path, st)
+                    destination_path = os.path.join(snapshot_dir, rel_path)
+                    if self.already_copied(done, rel_path, st, destination_path):
+                        self.stats['bytes_resumed'] += st.st_size
+                        continue
+                    self.make_dir(os.path.dirname(destination_path))
+                    copier.copy(file_path, destination_path, st.st_size, on_done=self.journal_file(rel_path, st), key=rel_path)
+                    self.stats['files'] += 1
+                    self.stats['bytes_written'] += st.st_size
+
+            # 记录自上次备份以来被删除的文件，恢复时需要用到
+            deleted = sorted(set(old_files) - set(new_files))
+            if deleted:
+                with open(os.path.join(snapshot_dir, '.deleted'), 'w', encoding='utf-8') as f:
+                    f.write('\n'.join(deleted) + '\n')
+                    f.flush()
+                    os.fsync(f.fileno())
+
+            self.write_checksums(os.path.join(snapshot_dir, CHECKSUM_FILE))
+            self.commit_partial(snapshot_dir, snapshot_name)
+            self.metrics.counters['bytes_output'] = self.stats['bytes_written']
+
+            # 备份成功后才更新清单，保证清单始终对应最后一次成功的备份
+            with self.metrics.phase('commit'):
+                save_manifest(path, {
+                    'increments': 0 if full else manifest['increments'] + 1,
+                    'last_snapshot': snapshot_name,
+                    'files': new_files,
+                })
+                if self.dir_index is not None:
+                    self.dir_index.save()
+            self.write_index(snapshot_name, 'dir')
+
+            end_time = time.time()
+            logger.info(f"备份完成：{self.source_dir} -> {self.destination_dir}，耗时：{end_time - start_time}秒，"
+                        f"写入{self.stats['files']}个文件共{self.stats['bytes_written']}字节，跳过未变化的{self.stats['bytes_skipped']}字节，复制方式：{copier.summary()}")
         except Exception as e:
+            self.close_journal()
             logger.error(f"备份失败：{self.source_dir} -> {self.destination_dir} 错误信息：{str(e)}")
             return False
         return True
 
-    def read_in_chunks(self,file_path, chunk_size):
-        with open(file_path, 'rb') as f:
+    # 找到上一次的完整快照目录（copy和snapshot方法产生的都是完整目录树）
+    def find_previous_snapshot(self):
+        pattern = re.compile(re.escape(self.file_name) + r'_\d{4}-\d{2}-\d{2}_\d{2}-\d{2}-\d{2}(_\d+)?$')
+        snapshots = [name for name in os.listdir(self.destination_dir)
+                     if pattern.match(name) and os.path.isdir(os.path.join(self.destination_dir, name))]
+        if not snapshots:
+            return None
+        # 时间戳格式可以直接按字符串排序
+        return os.path.join(self.destination_dir, max(snapshots))
+
+    def snapshot_file(self):
+        try:
+            logger.info(f'加载备份排除项列表：{self.exclude_path_list}')
+            logger.info(f'加载备份排除文件列表：{self.exclude_file_list}')
+            start_time = time.time()
+
+            previous_dir = self.find_previous_snapshot()
+            snapshot_name = self.file_name + '_' + time.strftime("%Y-%m-%d_%H-%M-%S", time.localtime())
+            header, snapshot_dir, records = self.begin_partial(snapshot_name)
+            snapshot_name = header['snapshot']
+            done = {record['path']: record for record in records}
+            logger.info(f'开始备份：{self.source_dir} -> {self.destination_dir}，目标文件名：{snapshot_name}，'
+                        f'参照快照：{os.path.basename(previous_dir) if previous_dir else "无（将完整复制）"}')
+
+            linked_files = 0
+            # 硬链接过来的文件和上个快照是同一个文件，直接沿用上个快照记录的哈希
+            previous_checksums = {}
+            if self.checksum and previous_dir:
+                algorithm, block_size, checksums = load_checksums(os.path.join(previous_dir, CHECKSUM_FILE))
+                if algorithm == self.checksum and block_size == CHECKSUM_BLOCK_SIZE:
+                    previous_checksums = checksums
+            os.makedirs(snapshot_dir, exist_ok=True)
+            with ParallelCopier(self.copy_workers, self.reflink, self.metrics, self.checksum, self.checksums, self.throttle) as copier:
+                for st in self.scan_source():
+                    if st.is_dir:
+                        continue
+                    file_path, rel_path = st.path, st.rel_path
+                    self.index_file(rel_path, st)
+                    destination_path = os.path.join(snapshot_dir, rel_path)
+                    if self.already_copied(done, rel_path, st, destination_path):
+                        self.stats['bytes_resumed'] += st.st_size
+                        continue
+                    self.make_dir(os.path.dirname(destination_path))
+                    # 上一个快照里大小和修改时间都一致的文件直接硬链接过来，不占用额外空间
+                    if previous_dir:
+                        previous_path = os.path.join(previous_dir, rel_path)
+                        try:
+                            previous_st = os.stat(previous_path)
+                            # 区域文件的修改时间变了，但区块保存时间表没变时，说明没有区块被重新保存，也可以直接链接
+                            if previous_st.st_size == st.st_size and (
+                                    previous_st.st_mtime_ns == st.st_mtime_ns or
+                                    (self.region_check and is_region_file(file_path) and same_region(file_path, previous_path))):
+                                remove_existing(destination_path)
+                                os.link(previous_path, destination_path)
+                                if self.checksum:
+                                    self.checksums[rel_path] = previous_checksums.get(rel_path) or hash_file(destination_path, self.checksum)
+                                self.journal_file(rel_path, st)()
+                                linked_files += 1
+                                self.stats['bytes_skipped'] += st.st_size
+                                continue
+                        except OSError:
+                            # 上个快照里没有这个文件，或者无法硬链接（比如跨盘、超过链接数上限），退回到复制
+                            pass
+                    copier.copy(file_path, destination_path, st.st_size, on_done=self.journal_file(rel_path, st), key=rel_path)
+                    self.stats['files'] += 1
+                    self.stats['bytes_written'] += st.st_size
+            self.write_checksums(os.path.join(snapshot_dir, CHECKSUM_FILE))
+            self.commit_partial(snapshot_dir, snapshot_name)
+            self.write_index(snapshot_name, 'dir')
+            self.metrics.counters['bytes_output'] = self.stats['bytes_written']
+
+            end_time = time.time()
+            logger.info(f"备份完成：{self.source_dir} -> {self.destination_dir}，耗时：{end_time - start_time}秒，"
+                        f"复制{self.stats['files']}个文件共{self.stats['bytes_written']}字节，硬链接{linked_files}个未变化的文件共{self.stats['bytes_skipped']}字节，复制方式：{copier.summary()}")
+        except Exception as e:
+            self.close_journal()
+            logger.error(f"备份失败：{self.source_dir} -> {self.destination_dir} 错误信息：{str(e)}")
+            return False
+        return True
+
+    # 把一个文件通过缓冲区流式写入压缩包
+    # hasher不为None时，读取的同时计算原始数据的哈希
+    def stream_to_zip(self, zipf, entry, buffer, view, store=False, hasher=None):
+        zinfo = zipinfo_from_entry(entry)
+        zinfo.compress_type = zipfile.ZIP_STORED if store else zipf.compression
+        zinfo._compresslevel = zipf.compresslevel
+        # 扫描时的文件大小已经填到zinfo里，zipf.open会据此决定是否启用ZIP64
+        with open(entry.path, 'rb') as src, zipf.open(zinfo, mode='w') as dest:
             while True:
-                chunk = f.read(chunk_size)
-                if not chunk:
+                n = src.readinto(buffer)
+                if not n:
                     break
-                yield chunk
+                if self.throttle is not None:
+                    self.throttle.read(n)
+                if hasher:
+                    hasher.update(view[:n])
+                dest.write(view[:n])
+        return zinfo
+
+    # 打开临时压缩包用于写入；继续上次中断的备份时，截掉最后一个完整成员之后的内容，并恢复已写入成员的目录
+    def open_partial_zip(self, partial_path, records):
+        if not records:
+            return open(partial_path, 'wb')
+        end = records[-1]['end']
+        fp = open(partial_path, 'r+b')
+        fp.truncate(end)
+        fp.seek(end)
+        return fp
 
     def zip_file(self):
         try:
             logger.info(f'加载备份排除项列表：{self.exclude_path_list}')
             logger.info(f'加载备份排除文件列表：{self.exclude_file_list}')
-            logger.info(f'开始备份：{self.source_dir} -> {self.destination_dir}，目标文件名：{self.file_name}.zip')
-            logger.info(f'压缩过程无需写入硬盘，无需担心硬盘写入寿命。内存最大占用量为500MB，可根据需要调整。')
+            logger.info(f'开始备份：{self.source_dir} -> {self.destination_dir}，目标文件名：{self.file_name}.zip，压缩算法：{self.compression}，压缩等级：{self.compression_level if self.compression_level is not None else "默认"}')
+            logger.info(f'压缩过程无需写入硬盘，无需担心硬盘写入寿命。文件以流的方式写入压缩包，读取缓冲区大小为{self.zip_chunk_size}字节。')
             start_time = time.time()
 
             destination_zip = self.file_name + '_' + time.strftime("%Y-%m-%d_%H-%M-%S", time.localtime()) + '.zip'
-            # 创建一个ZipFile对象，用于写入压缩文件
-            with zipfile.ZipFile(self.destination_dir + '/' +destination_zip, 'w', zipfile.ZIP_DEFLATED) as zipf:
-                zip_path_list = []  # 用于存储压缩文件的路径
-                # 遍历文件夹下的所有文件，并根据排除项列表进行筛选备份
-                for root, dirs, files in os.walk(self.source_dir):
-                    for file in files:
-                        file_path = os.path.join(root, file)
-                        rel_path = os.path.relpath(file_path, self.source_dir)
-                        if (self.exclude_path_list and any(dir_name in rel_path for dir_name in self.exclude_path_list)) or \
-                        (self.exclude_file_list and any(re.match(pattern, rel_path) for pattern in self.exclude_file_list)):
-                            logger.info(f'排除文件：{file_path}')
-                            continue  # 跳过符合排除条件的文件
-                        
-                        # 写入文件到压缩文件
-                        zip_path_list.append((file_path, rel_path))
-                with open(file_path, 'rb') as f:
-                    global ZIP_CHUNK_SIZE
-                    for file_path, rel_path in zip_path_list:
-                        logger.info(f'正在压缩文件：{file_path}')
-                        # 如果文件小于500M，直接压缩
-                        if os.path.getsize(file_path) < ZIP_CHUNK_SIZE:
-                            zipf.write(file_path, rel_path)
-                        # 如果文件大于500M，分块压缩
-                        else:
-                            with open(file_path, 'rb') as f:
-                                # 检查是否存在同名文件，如果存在则追加写入到末尾
-                                if rel_path in zipf.namelist():
-                                    with zipf.open(rel_path, mode='a') as existing_file:
-                                        for chunk in self.read_in_chunks(file_path, ZIP_CHUNK_SIZE):
-                                            existing_file.write(chunk)
-                                else:
-                                    # 创建新的同名文件并写入内容
-                                    with zipf.open(rel_path, mode='w') as new_file:
-                                        for chunk in self.read_in_chunks(file_path, ZIP_CHUNK_SIZE):
-                                            new_file.write(chunk)
+            header, partial_path, records = self.begin_partial(destination_zip)
+            destination_zip = header['snapshot']
+            done = {record['name'] for record in records}
+            for record in records:
+                if record.get('checksum'):
+                    self.checksums[record['name']] = record['checksum']
+            # 创建一个ZipFile对象，用于写入压缩文件，先写到临时文件里
+            with self.open_partial_zip(partial_path, records) as fp:
+                # 限速时通过ThrottledWriter写入压缩包
+                out = self.throttle.writer(fp) if self.throttle is not None else fp
+                with zipfile.ZipFile(out, 'w', ZIP_CODECS[self.compression], compresslevel=self.compression_level) as zipf:
+                    for record in records:
+                        zinfo = zipinfo_from_record(record)
+                        zipf.filelist.append(zinfo)
+                        zipf.NameToInfo[zinfo.filename] = zinfo
+                    # 遍历文件夹下的所有文件，并根据排除项列表进行筛选备份，边扫描边压缩，跳过上次已经写入的文件
+                    entries = (entry for entry in self.walk_source_files() if entry.rel_path not in done)
+                    # 已经压缩过的文件（图片、视频、压缩包、区域文件等）直接存储，不再浪费CPU
+                    store_func = is_incompressible if self.store_incompressible and self.compression != 'store' else None
+                    # 每个成员开始写入的时间，用于统计慢文件
+                    member_start = {}
+
+                    def on_file(file_path, rel_path):
+                        logger.debug(f'正在压缩文件：{file_path}')
+                        member_start[rel_path] = (file_path, time.perf_counter())
+
+                    # 每写完一个成员记录一次检查点
+                    def on_member(zinfo, end, digest=None):
+                        record = zipinfo_to_record(zinfo, end)
+                        if digest:
+                            record['checksum'] = self.checksums[zinfo.filename] = digest
+                        self.journal.append(record)
+                        file_path, member_time = member_start.pop(zinfo.filename)
+                        self.stats['files'] += 1
+                        self.metrics.file_done(file_path, zinfo.file_size, time.perf_counter() - member_time)
+
+                    # 多进程并行压缩，大文件会被切成块分给不同的进程，只支持deflate
+                    if self.zip_workers > 1 and self.compression == 'deflate':
+                        logger.info(f'使用{self.zip_workers}个进程并行压缩')
+                        level = self.compression_level if self.compression_level is not None else zlib.Z_DEFAULT_COMPRESSION
+                        write_parallel(zipf, entries, self.zip_workers, level=level, store_func=store_func,
+                                       on_file=on_file, on_member=on_member, checksum=self.checksum, throttle=self.throttle)
+                    else:
+                        # 所有文件共用一个固定大小的缓冲区，内存占用和文件大小无关
+                        buffer = bytearray(self.zip_chunk_size)
+                        view = memoryview(buffer)
+                        for entry in entries:
+                            on_file(entry.path, entry.rel_path)
+                            hasher = TreeHasher(self.checksum) if self.checksum else None
+                            zinfo = self.stream_to_zip(zipf, entry, buffer, view, store=bool(store_func and store_func(entry.path)), hasher=hasher)
+                            on_member(zinfo, zipf.start_dir, hasher.hexdigest() if hasher else None)
+                fp.flush()
+                os.fsync(fp.fileno())
+                self.stats['bytes_written'] = self.metrics.counters['bytes_output'] = fp.tell()
+            self.commit_partial(partial_path, destination_zip)
+            self.write_checksums(os.path.join(self.destination_dir, destination_zip + CHECKSUM_FILE))
+            # 索引里记录每个成员的本地文件头位置，恢复单个文件时直接跳过去读取
+            self.write_index(destination_zip, 'zip', [zipinfo_entry(zinfo, self.checksums.get(zinfo.filename)) for zinfo in zipf.infolist()])
 
             end_time = time.time()           
             logger.info(f"备份完成：{self.source_dir} -> {self.destination_dir}，耗时：{end_time - start_time}秒")
         except Exception as e:
+            self.close_journal()
+            logger.error(f"备份失败：{self.source_dir} -> {self.destination_dir} 错误信息：{str(e)}")
+            if self.exception_notification_path:
+                # 把错误信息写到exception_notification_path/error.log，如果没有则创建
+                os.makedirs(self.exception_notification_path, exist_ok=True)
+                with open(os.path.join(self.exception_notification_path, 'error.log'), 'w', encoding='utf-8') as file:
+                    file.write(f'[{time.strftime("%Y-%m-%d %H:%M:%S", time.localtime())}] {str(e)}\n')
+            return False
+        return True
+
+    def tar_file(self):
+        try:
+            logger.info(f'加载备份排除项列表：{self.exclude_path_list}')
+            logger.info(f'加载备份排除文件列表：{self.exclude_file_list}')
+            destination_tar = self.file_name + '_' + time.strftime("%Y-%m-%d_%H-%M-%S", time.localtime()) + TAR_CODECS[self.compression]
+            logger.info(f'开始备份：{self.source_dir} -> {self.destination_dir}，目标文件名：{destination_tar}，压缩算法：{self.compression}，压缩等级：{self.compression_level if self.compression_level is not None else "默认"}')
+            start_time = time.time()
+
+            # 压缩流无法从中间继续，中断后只能重新开始，但临时名字保证不会留下不完整的备份
+            header, partial_path, _ = self.begin_partial(destination_tar, resumable=False)
+            destination_tar = header['snapshot']
+            # tar是整体压缩的，无法按文件跳过压缩；zstd和lz4遇到不可压缩的数据本身就很快
+            with open_tar(partial_path, self.compression, self.compression_level, self.compression_threads,
+                          wrap=self.throttle.writer if self.throttle is not None else None) as tar:
+                names = {}  # 用户名、组名的缓存
+                for entry in self.walk_source_files():
+                    logger.debug(f'正在压缩文件：{entry.path}')
+                    file_start = time.perf_counter()
+                    # 扫描结果只包含普通文件（指向文件的符号链接按它指向的文件处理，和zip、复制一致），直接用扫描时的stat结果
+                    tarinfo = tarinfo_from_entry(entry, names)
+                    with open(entry.path, 'rb') as f:
+                        if self.throttle is not None:
+                            f = self.throttle.reader(f)
+                        if self.checksum:
+                            # 让tarfile通过HashingReader读取文件，写入的同时计算哈希
+                            reader = HashingReader(f, self.checksum)
+                            tar.addfile(tarinfo, reader)
+                            self.checksums[entry.rel_path] = reader.hexdigest()
+                        else:
+                            tar.addfile(tarinfo, f)
+                    self.index_entries[entry.rel_path] = (tarinfo.size, tarinfo.mtime)
+                    self.stats['files'] += 1
+                    self.metrics.file_done(entry.path, tarinfo.size, time.perf_counter() - file_start)
+            # 压缩流关闭时会一并关闭文件，只能关闭后再fsync
+            fsync_file(partial_path)
+            self.stats['bytes_written'] = self.metrics.counters['bytes_output'] = os.path.getsize(partial_path)
+            self.commit_partial(partial_path, destination_tar)
+            self.write_checksums(os.path.join(self.destination_dir, destination_tar + CHECKSUM_FILE))
+            self.write_index(destination_tar, 'tar')
+
+            end_time = time.time()
+            logger.info(f"备份完成：{self.source_dir} -> {self.destination_dir}，耗时：{end_time - start_time}秒")
+        except Exception as e:
+            self.close_journal()
             logger.error(f"备份失败：{self.source_dir} -> {self.destination_dir} 错误信息：{str(e)}")
-            if EXECEPTION_NOTIFICATION_PATH != '':
-                # 把当前日志复制到EXECEPTION_NOTIFICATION_PATH/error.log，如果没有则创建
-                os.makedirs(EXECEPTION_NOTIFICATION_PATH, exist_ok=True)
-                with open(os.path.join(EXECEPTION_NOTIFICATION_PATH, 'error.log'), 'w', encoding='utf-8') as file:
-                    with open('log.log', 'r', encoding='utf-8') as log:
-                        file.write(f'[{time.strftime("%Y-%m-%d %H:%M:%S", time.localtime())}] {str(e)}\n')
             return False
         return True
 
@@ -122,14 +564,39 @@ class BackupTask:
             logger.warning(f'目标所在的硬盘的剩余空间小于10GB，跳过备份')
             return False
         
+        # 如果备份模式为server_world_only或mcdr_server_world_only，则只备份服务器存档（包含level.dat的文件夹）
+        if self.predefine_patterns in WORLD_PATTERNS:
+            self.world_dirs = find_worlds(self.source_dir, mcdr=self.predefine_patterns == 'mcdr_server_world_only')
+            if not self.world_dirs:
+                logger.error(f'备份模式：{self.predefine_patterns}，但在{self.source_dir}下没有找到存档（包含{WORLD_MARKER}的文件夹）')
+                return False
+            logger.info(f'备份模式：{self.predefine_patterns}，只备份存档：{", ".join(self.world_dirs)}')
+            # 区域文件只有区块保存时间变了才算变化，频繁备份大存档时只需要复制真正有区块被保存过的区域文件
+            self.region_check = True
         # 如果备份模式为all，则备份除过exclude list的所有文件
-        if self.predefine_patterns == 'all':
+        elif self.predefine_patterns == 'all':
             logger.info(f'备份模式：all，备份除过exclude list的所有文件')
-            # 如果备份方法为copy，则复制文件
-            if self.backup_method == 'copy':
-                logger.info(f'备份方法：copy，直接复制文件')
-                return self.copy_file() # 可以识别备份失败
-            # 如果备份方法为zip，则压缩文件
-            elif self.backup_method == 'zip':
-                logger.info(f'备份方法：zip，压缩后复制文件')
-                return self.zip_file()
\ No newline at end of file
+        else:
+            logger.warning(f'备份模式{self.predefine_patterns}不需要备份任何文件')
+            return False
+
+        # 如果备份方法为copy，则复制文件
+        if self.backup_method == 'copy':
+            logger.info(f'备份方法：copy，直接复制文件')
+            return self.copy_file() # 可以识别备份失败
+        # 如果备份方法为zip，则压缩文件
+        elif self.backup_method == 'zip':
+            logger.info(f'备份方法：zip，压缩后复制文件')
+            return self.zip_file()
+        # 如果备份方法为tar，则打包后用zstd、lz4等算法压缩
+        elif self.backup_method == 'tar':
+            logger.info(f'备份方法：tar，打包后使用{self.compression}压缩')
+            return self.tar_file()
+        # 如果备份方法为incremental，则只复制自上次备份以来变化的文件
+        elif self.backup_method == 'incremental':
+            logger.info(f'备份方法：incremental，只复制变化的文件，每{self.full_backup_interval}次增量后进行一次全量备份')
+            return self.incremental_file()
+        # 如果备份方法为snapshot，则生成完整的快照目录，未变化的文件硬链接到上一个快照
+        elif self.backup_method == 'snapshot':
+            logger.info(f'备份方法：snapshot，未变化的文件硬链接到上一个快照，只复制变化的文件')
+            return self.snapshot_file()
\ No newline at end of file
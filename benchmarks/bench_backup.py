@@ -0,0 +1,247 @@
+# 备份吞吐量基准测试：生成可复现的合成源目录，分别用各个备份方法和不同的zip_chunk_size备份，
+# 输出每次备份的文件数/秒、MB/秒、峰值内存（RSS）和耗时
+# 用法：python benchmarks/bench_backup.py [--scale 0.1] [--scenarios tiny_files,huge_files] [--methods copy,zip]
+#                                         [--chunk-sizes 65536,1048576] [--json result.json] [--compare baseline.json]
+# 每次备份都在单独的子进程里执行，峰值内存互不影响；--json保存结果，--compare和之前保存的结果比较，变慢超过阈值时返回1
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import resource
+import tempfile
+import subprocess
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SEED = 20240101  # 固定随机种子，每次生成的源目录完全一样
+DEFAULT_CHUNK_SIZES = [64 * 1024, 1024 * 1024, 8 * 1024 * 1024]
+REGRESSION_THRESHOLD = 0.15  # 和基线相比，MB/秒下降超过15%视为退化
+METHOD_FUNCS = {
+    'copy': 'copy_file',
+    'zip': 'zip_file',
+    'tar': 'tar_file',
+    'incremental': 'incremental_file',
+    'snapshot': 'snapshot_file',
+}
+TEXT_WORDS = [b'rigorous', b'automatic', b'backup', b'minecraft', b'region', b'level', b'chunk', b'server', b'world', b'player']
+
+
+# 可压缩的数据：随机排列的单词，压缩率和日志、配置文件差不多
+def compressible_bytes(rng, size):
+    data = bytearray()
+    while len(data) < size:
+        data += b' '.join(rng.choice(TEXT_WORDS) for _ in range(64)) + b'\n'
+    return bytes(data[:size])
+
+
+# 随机数据，无法压缩，和图片、视频、区域文件差不多
+def random_bytes(rng, size):
+    return rng.randbytes(size)
+
+
+def write_file(path, rng, size, compressible):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as f:
+        # 大文件分块生成，避免一次性占用大量内存
+        remaining = size
+        while remaining > 0:
+            n = min(remaining, 4 * 1024 * 1024)
+            f.write(compressible_bytes(rng, n) if compressible else random_bytes(rng, n))
+            remaining -= n
+
+
+# 以下每个函数生成一种源目录，返回(排除路径列表, 排除文件正则列表)
+def make_tiny_files(root, rng, scale):
+    for i in range(int(20000 * scale)):
+        write_file(os.path.join(root, f'd{i % 100}', f'f{i}.txt'), rng, rng.randint(100, 2048), True)
+    return [], []
+
+
+def make_huge_files(root, rng, scale):
+    for i in range(2):
+        write_file(os.path.join(root, f'huge{i}.bin'), rng, int(256 * 1024 * 1024 * scale), i == 0)
+    return [], []
+
+
+def make_deep_tree(root, rng, scale):
+    for branch in range(4):
+        path = os.path.join(root, f'b{branch}')
+        for depth in range(max(1, int(40 * scale))):
+            path = os.path.join(path, f'level{depth}')
+            for i in range(5):
+                write_file(os.path.join(path, f'f{i}.dat'), rng, 4096, True)
+    return [], []
+
+
+def make_compressible(root, rng, scale):
+    for i in range(max(1, int(200 * scale))):
+        write_file(os.path.join(root, f'd{i % 10}', f'log{i}.log'), rng, 1024 * 1024, True)
+    return [], []
+
+
+def make_random(root, rng, scale):
+    for i in range(max(1, int(200 * scale))):
+        write_file(os.path.join(root, f'd{i % 10}', f'r{i}.dat'), rng, 1024 * 1024, False)
+    return [], []
+
+
+# 大量排除项：一半的文件夹被路径排除，另有大量正则只匹配少数文件，测试排除规则本身的开销
+def make_heavy_excludes(root, rng, scale):
+    dirs = 100
+    for i in range(int(5000 * scale)):
+        write_file(os.path.join(root, f'd{i % dirs}', f'f{i}.{rng.choice(["txt", "log", "dat", "mca"])}'), rng, 1024, True)
+    exclude_path_list = [f'd{i}' for i in range(0, dirs, 2)] + [f'missing/path{i}' for i in range(200)]
+    exclude_file_list = [rf'f{i}\.log$' for i in range(0, 500, 3)] + [rf'.*/cache{i}/.*' for i in range(100)]
+    return exclude_path_list, exclude_file_list
+
+
+SCENARIOS = {
+    'tiny_files': make_tiny_files,
+    'huge_files': make_huge_files,
+    'deep_tree': make_deep_tree,
+    'compressible': make_compressible,
+    'random': make_random,
+    'heavy_excludes': make_heavy_excludes,
+}
+
+
+# 统计源目录的文件数和总大小，用于计算吞吐量（不考虑排除项，保证不同版本之间可比）
+def tree_size(root):
+    files = 0
+    total = 0
+    for dirpath, _, filenames in os.walk(root):
+        for name in filenames:
+            files += 1
+            total += os.path.getsize(os.path.join(dirpath, name))
+    return files, total
+
+
+# 子进程：执行一次备份，输出耗时和峰值内存
+def run_child(args):
+    sys.path.insert(0, REPO_DIR)
+    from logger_config import set_log_level
+    from back_up import BackupTask
+
+    set_log_level('WARNING')
+    params = json.loads(args)
+    task = BackupTask(params['source_dir'], params['destination_dir'], params['method'], 'all',
+                      params['exclude_path_list'], params['exclude_file_list'], 'bench',
+                      zip_chunk_size=params['chunk_size'], zip_workers=params['zip_workers'],
+                      compression=params['compression'], scan_workers=params['scan_workers'],
+                      copy_workers=params['copy_workers'])
+    start_time = time.perf_counter()
+    ok = getattr(task, METHOD_FUNCS[params['method']])()
+    wall_time = time.perf_counter() - start_time
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux下ru_maxrss的单位是KB，macOS下是字节
+    if sys.platform == 'darwin':
+        max_rss //= 1024
+    print(json.dumps({'ok': ok, 'wall_time': wall_time, 'max_rss_kb': max_rss}))
+
+
+def run_case(tmp_dir, source_dir, method, chunk_size, exclude_path_list, exclude_file_list, options):
+    destination_dir = tempfile.mkdtemp(dir=tmp_dir)
+    params = {
+        'source_dir': source_dir,
+        'destination_dir': destination_dir,
+        'method': method,
+        'chunk_size': chunk_size,
+        'exclude_path_list': exclude_path_list,
+        'exclude_file_list': exclude_file_list,
+        'zip_workers': options.zip_workers,
+        'compression': options.tar_compression if method == 'tar' else None,
+        'scan_workers': options.scan_workers,
+        'copy_workers': options.copy_workers,
+    }
+    try:
+        output = subprocess.run([sys.executable, os.path.abspath(__file__), '--child', json.dumps(params)],
+                                cwd=tmp_dir, check=True, capture_output=True, text=True).stdout
+        return json.loads(output.strip().splitlines()[-1])
+    finally:
+        shutil.rmtree(destination_dir, ignore_errors=True)
+
+
+# 和基线结果比较，返回退化的条目
+def compare(results, baseline_path):
+    with open(baseline_path, 'r', encoding='utf-8') as f:
+        baseline = {(r['scenario'], r['method'], r['chunk_size']): r for r in json.load(f)['results']}
+    regressions = []
+    for result in results:
+        old = baseline.get((result['scenario'], result['method'], result['chunk_size']))
+        if not old or not old['mb_per_s']:
+            continue
+        change = result['mb_per_s'] / old['mb_per_s'] - 1
+        print(f'{result["scenario"]:>15} {result["method"]:>12} {result["chunk_size"] or "-":>9}  '
+              f'{old["mb_per_s"]:9.1f} -> {result["mb_per_s"]:9.1f} MB/s ({change:+.1%})')
+        if change < -REGRESSION_THRESHOLD:
+            regressions.append(result)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='备份吞吐量基准测试')
+    parser.add_argument('--scale', type=float, default=1.0, help='源目录规模的缩放系数，默认1（约1GB）')
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS), help=f'要测试的源目录类型，可选：{",".join(SCENARIOS)}')
+    parser.add_argument('--methods', default=','.join(METHOD_FUNCS), help=f'要测试的备份方法，可选：{",".join(METHOD_FUNCS)}')
+    parser.add_argument('--chunk-sizes', default=','.join(str(size) for size in DEFAULT_CHUNK_SIZES),
+                        help='zip的读取缓冲区大小（字节），只对zip生效')
+    parser.add_argument('--zip-workers', type=int, default=1, help='zip并行压缩的进程数')
+    parser.add_argument('--scan-workers', type=int, default=1, help='扫描源目录的线程数')
+    parser.add_argument('--copy-workers', type=int, default=1, help='复制文件的线程数')
+    parser.add_argument('--tar-compression', default='gzip', help='tar使用的压缩算法，默认gzip（不需要额外安装）')
+    parser.add_argument('--json', help='把结果保存为JSON文件')
+    parser.add_argument('--compare', help='和之前保存的JSON结果比较，MB/s下降超过阈值时返回1')
+    options = parser.parse_args()
+
+    chunk_sizes = [int(size) for size in options.chunk_sizes.split(',')]
+    results = []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for scenario in options.scenarios.split(','):
+            source_dir = os.path.join(tmp_dir, scenario)
+            print(f'生成源目录{scenario}...')
+            exclude_path_list, exclude_file_list = SCENARIOS[scenario](source_dir, random.Random(SEED), options.scale)
+            files, total = tree_size(source_dir)
+            for method in options.methods.split(','):
+                # 只有zip会用到读取缓冲区大小，其他方法只测一次
+                for chunk_size in (chunk_sizes if method == 'zip' else chunk_sizes[:1]):
+                    result = run_case(tmp_dir, source_dir, method, chunk_size, exclude_path_list, exclude_file_list, options)
+                    wall_time = max(result['wall_time'], 1e-9)
+                    results.append({
+                        'scenario': scenario,
+                        'method': method,
+                        'chunk_size': chunk_size if method == 'zip' else None,
+                        'ok': result['ok'],
+                        'files': files,
+                        'bytes': total,
+                        'wall_time': wall_time,
+                        'files_per_s': files / wall_time,
+                        'mb_per_s': total / 1024 / 1024 / wall_time,
+                        'max_rss_mb': result['max_rss_kb'] / 1024,
+                    })
+                    r = results[-1]
+                    print(f'{scenario:>15} {method:>12} {r["chunk_size"] or "-":>9}  {"成功" if r["ok"] else "失败"}  {files:>7}个文件  '
+                          f'{r["wall_time"]:8.2f}秒  {r["files_per_s"]:10.1f}文件/秒  {r["mb_per_s"]:8.1f}MB/秒  峰值内存{r["max_rss_mb"]:7.1f}MB')
+
+    if options.json:
+        with open(options.json, 'w', encoding='utf-8') as f:
+            json.dump({'python': sys.version.split()[0], 'scale': options.scale, 'time': time.strftime("%Y-%m-%d %H:%M:%S"),
+                       'results': results}, f, ensure_ascii=False, indent=2)
+        print(f'结果已保存到{options.json}')
+
+    failed = [r for r in results if not r['ok']]
+    regressions = compare(results, options.compare) if options.compare else []
+    if failed:
+        print(f'失败：{len(failed)}次备份没有成功')
+    if regressions:
+        print(f'失败：{len(regressions)}项和基线相比MB/s下降超过{REGRESSION_THRESHOLD:.0%}')
+    if failed or regressions:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == '--child':
+        run_child(sys.argv[2])
+    else:
+        main()
@@ -0,0 +1,79 @@
+# 验证zip备份的内存占用与文件大小无关
+# 用法：python benchmarks/bench_zip_memory.py [文件大小GB，默认4] [zip_workers，默认1]
+# 会在临时目录里生成一个大文件，在子进程中执行zip备份，并输出子进程的峰值内存（RSS）
+# zip_workers大于1时还会输出压缩进程的峰值内存，以及所有进程同时达到峰值时的总内存（上限估计）
+import os
+import sys
+import json
+import resource
+import tempfile
+import subprocess
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MAX_RSS_MB = 256  # 备份进程或单个压缩进程的峰值内存超过这个值视为失败
+
+
+# 生成指定大小的文件，一半是随机数据，一半是可压缩的数据
+def make_large_file(path, size):
+    block = os.urandom(1024 * 512) + b'rigorous-automatic-backup ' * 20165
+    with open(path, 'wb') as f:
+        written = 0
+        while written < size:
+            data = block[:size - written]
+            f.write(data)
+            written += len(data)
+
+
+def max_rss_kb(who):
+    max_rss = resource.getrusage(who).ru_maxrss
+    # Linux下ru_maxrss的单位是KB，macOS下是字节
+    if sys.platform == 'darwin':
+        max_rss //= 1024
+    return max_rss
+
+
+# 子进程：执行一次zip备份，输出峰值内存
+def run_child(source_dir, destination_dir, zip_workers):
+    sys.path.insert(0, REPO_DIR)
+    from back_up import BackupTask
+
+    task = BackupTask(source_dir, destination_dir, 'zip', 'all', [], [], 'bench', zip_workers=zip_workers)
+    ok = task.zip_file()
+    # zip_file返回时进程池已经关闭，压缩进程都已退出并被回收，RUSAGE_CHILDREN是其中峰值内存最大的一个
+    print(json.dumps({'ok': ok, 'max_rss_kb': max_rss_kb(resource.RUSAGE_SELF), 'worker_max_rss_kb': max_rss_kb(resource.RUSAGE_CHILDREN)}))
+
+
+def main():
+    size_gb = float(sys.argv[1]) if len(sys.argv) > 1 else 4
+    zip_workers = int(sys.argv[2]) if len(sys.argv) > 2 else 1
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        source_dir = os.path.join(tmp_dir, 'source')
+        destination_dir = os.path.join(tmp_dir, 'destination')
+        os.makedirs(source_dir)
+        os.makedirs(destination_dir)
+
+        size = int(size_gb * 1024 ** 3)
+        print(f'生成{size_gb}GB测试文件...')
+        make_large_file(os.path.join(source_dir, 'large.bin'), size)
+
+        print(f'开始压缩，zip_workers={zip_workers}...')
+        output = subprocess.run([sys.executable, os.path.abspath(__file__), '--child', source_dir, destination_dir, str(zip_workers)],
+                                cwd=tmp_dir, check=True, capture_output=True, text=True).stdout
+        result = json.loads(output.strip().splitlines()[-1])
+
+    max_rss_mb = result['max_rss_kb'] / 1024
+    worker_max_rss_mb = result['worker_max_rss_kb'] / 1024 if zip_workers > 1 else 0
+    print(f'备份结果：{result["ok"]}，文件大小：{size_gb}GB，峰值内存：{max_rss_mb:.1f}MB')
+    if zip_workers > 1:
+        print(f'单个压缩进程峰值内存：{worker_max_rss_mb:.1f}MB，'
+              f'总内存上限估计：{max_rss_mb + worker_max_rss_mb * zip_workers:.1f}MB（{zip_workers}个压缩进程同时达到峰值）')
+    if not result['ok'] or max(max_rss_mb, worker_max_rss_mb) > MAX_RSS_MB:
+        print(f'失败：峰值内存超过{MAX_RSS_MB}MB或备份失败')
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == '--child':
+        run_child(sys.argv[2], sys.argv[3], int(sys.argv[4]))
+    else:
+        main()
@@ -0,0 +1,158 @@
+import os
+import hashlib
+
+# xxhash是可选依赖，没有安装时只能使用blake2b
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+# 这个模块会在并行压缩的子进程里被导入，所以不要导入logger_config
+
+CHECKSUM_ALGORITHMS = ['blake2b', 'xxh3']
+CHECKSUM_FILE = '.checksums'  # 文件夹形式的备份，校验文件放在备份文件夹里；压缩包的校验文件是<压缩包名>.checksums
+CHECKSUM_BLOCK_SIZE = 1024 * 1024 * 16  # 按16MB分块计算哈希，和并行压缩的分块大小一致
+READ_SIZE = 1024 * 1024 * 4  # 计算哈希时每次顺序读取4MB
+
+
+def check_checksum_algorithm(algorithm):
+    if algorithm not in CHECKSUM_ALGORITHMS:
+        return f'校验算法应为{", ".join(CHECKSUM_ALGORITHMS)}中的一个，不支持{algorithm}'
+    if algorithm == 'xxh3' and xxhash is None:
+        return '使用xxh3校验需要先安装xxhash：pip install xxhash'
+    return None
+
+
+def _new_hash(algorithm):
+    if algorithm == 'xxh3':
+        return xxhash.xxh3_128()
+    return hashlib.blake2b(digest_size=32)
+
+
+# 计算一块数据的哈希（树哈希的叶子）
+def block_digest(algorithm, data):
+    h = _new_hash(algorithm)
+    h.update(data)
+    return h.digest()
+
+
+# 由各块的哈希得到整个文件的哈希
+def combine_digests(algorithm, digests):
+    h = _new_hash(algorithm)
+    for digest in digests:
+        h.update(digest)
+    return h.hexdigest()
+
+
+# 分块树哈希：文件按CHECKSUM_BLOCK_SIZE分块，每块单独计算哈希，再对各块的哈希计算一次哈希
+# 这样并行压缩时各个进程可以分别计算自己那块的哈希，校验大文件时也可以多个线程同时计算
+class TreeHasher:
+    def __init__(self, algorithm, block_size=CHECKSUM_BLOCK_SIZE):
+        self.algorithm = algorithm
+        self.block_size = block_size
+        self.digests = []
+        self.block = _new_hash(algorithm)
+        self.block_used = 0
+
+    def update(self, data):
+        view = memoryview(data)
+        while len(view):
+            n = min(len(view), self.block_size - self.block_used)
+            self.block.update(view[:n])
+            self.block_used += n
+            view = view[n:]
+            if self.block_used == self.block_size:
+                self.digests.append(self.block.digest())
+                self.block = _new_hash(self.algorithm)
+                self.block_used = 0
+
+    def hexdigest(self):
+        digests = self.digests + ([self.block.digest()] if self.block_used else [])
+        return combine_digests(self.algorithm, digests)
+
+
+# 读取文件的一块并计算哈希，校验时多个线程分别计算不同的块
+def hash_block(path, algorithm, offset, length):
+    h = _new_hash(algorithm)
+    buffer = bytearray(min(READ_SIZE, max(length, 1)))
+    view = memoryview(buffer)
+    with open(path, 'rb') as f:
+        f.seek(offset)
+        remaining = length
+        while remaining > 0:
+            n = f.readinto(view[:min(remaining, len(buffer))])
+            if not n:
+                break
+            h.update(view[:n])
+            remaining -= n
+    return h.digest()
+
+
+# 计算整个文件的树哈希
+def hash_file(path, algorithm, block_size=CHECKSUM_BLOCK_SIZE):
+    size = os.path.getsize(path)
+    return combine_digests(algorithm, [hash_block(path, algorithm, offset, min(block_size, size - offset))
+                                       for offset in range(0, size, block_size)])
+
+
+# 在用户态分块复制文件，algorithm不为None时同时计算哈希（只读一遍源文件），返回哈希
+# throttle（throttle.Throttle）不为None时每块读写前限速
+# 需要经过用户态，所以开启校验或限速时不能使用reflink、copy_file_range等内核复制方式
+def copy_and_hash(src, dst, algorithm, throttle=None):
+    hasher = TreeHasher(algorithm) if algorithm else None
+    buffer = bytearray(READ_SIZE)
+    view = memoryview(buffer)
+    with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+        while True:
+            n = fsrc.readinto(buffer)
+            if not n:
+                break
+            if throttle is not None:
+                throttle.read(n)
+                throttle.write(n)
+            if hasher is not None:
+                hasher.update(view[:n])
+            fdst.write(view[:n])
+        fdst.flush()
+        os.fsync(fdst.fileno())
+    return hasher.hexdigest() if hasher else None
+
+
+# 包装一个可读的文件对象，读取时顺便计算哈希，用于tar等由别的库负责读取文件的场景
+class HashingReader:
+    def __init__(self, fileobj, algorithm):
+        self.fileobj = fileobj
+        self.hasher = TreeHasher(algorithm)
+
+    def read(self, size=-1):
+        data = self.fileobj.read(size)
+        self.hasher.update(data)
+        return data
+
+    def hexdigest(self):
+        return self.hasher.hexdigest()
+
+
+# 保存校验文件：第一行是算法和分块大小，之后每行是"哈希  相对路径"
+def save_checksums(path, algorithm, checksums):
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        f.write(f'# {algorithm} {CHECKSUM_BLOCK_SIZE}\n')
+        for rel_path in sorted(checksums):
+            f.write(f'{checksums[rel_path]}  {rel_path}\n')
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+# 读取校验文件，返回(算法, 分块大小, {相对路径: 哈希})，文件不存在时返回(None, None, {})
+def load_checksums(path):
+    if not os.path.exists(path):
+        return None, None, {}
+    checksums = {}
+    with open(path, 'r', encoding='utf-8') as f:
+        _, algorithm, block_size = f.readline().split()
+        for line in f:
+            digest, rel_path = line.rstrip('\n').split('  ', 1)
+            checksums[rel_path] = digest
+    return algorithm, int(block_size), checksums
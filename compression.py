@@ -0,0 +1,166 @@
+import os
+import stat
+import zlib
+import tarfile
+import zipfile
+import contextlib
+
+# zstd和lz4是可选依赖，没有安装时只能使用标准库自带的压缩算法
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+# 用于查询tar成员的用户名和组名，Windows上没有
+try:
+    import pwd
+    import grp
+except ImportError:
+    pwd = grp = None
+
+# zip支持的压缩算法
+ZIP_CODECS = {
+    'deflate': zipfile.ZIP_DEFLATED,
+    'bzip2': zipfile.ZIP_BZIP2,
+    'lzma': zipfile.ZIP_LZMA,
+    'store': zipfile.ZIP_STORED,
+}
+# tar支持的压缩算法，以及对应的文件后缀
+TAR_CODECS = {
+    'zstd': '.tar.zst',
+    'lz4': '.tar.lz4',
+    'gzip': '.tar.gz',
+    'xz': '.tar.xz',
+    'bzip2': '.tar.bz2',
+    'store': '.tar',
+}
+# 各备份方法默认使用的压缩算法
+DEFAULT_CODECS = {
+    'zip': 'deflate',
+    'tar': 'zstd',
+}
+# 各压缩算法允许的压缩等级范围
+CODEC_LEVELS = {
+    'deflate': (0, 9),
+    'gzip': (0, 9),
+    'bzip2': (1, 9),
+    'lzma': (0, 9),
+    'xz': (0, 9),
+    'zstd': (1, 22),
+    'lz4': (0, 16),
+}
+
+# 本身已经压缩过的文件格式，再压缩一次只会浪费CPU
+INCOMPRESSIBLE_EXTENSIONS = {
+    '.zip', '.gz', '.tgz', '.bz2', '.xz', '.zst', '.lz4', '.7z', '.rar', '.jar',
+    '.jpg', '.jpeg', '.png', '.gif', '.webp', '.mp3', '.mp4', '.mkv', '.avi', '.mov', '.flac', '.ogg', '.m4a',
+    '.mca', '.mcr',  # Minecraft的区域文件，里面的区块已经是压缩过的
+}
+SAMPLE_SIZE = 64 * 1024  # 采样压缩测试读取的大小
+SAMPLE_RATIO = 0.95  # 采样压缩后大小超过原来的95%，就认为不值得压缩
+
+
+# 检查压缩算法是否可用，可用返回None，不可用返回原因
+def check_codec(backup_method, codec, level=None):
+    if backup_method == 'zip' and codec not in ZIP_CODECS:
+        return f'zip支持的压缩算法为{", ".join(ZIP_CODECS)}，不支持{codec}'
+    if backup_method == 'tar' and codec not in TAR_CODECS:
+        return f'tar支持的压缩算法为{", ".join(TAR_CODECS)}，不支持{codec}'
+    if codec == 'zstd' and zstandard is None:
+        return '使用zstd压缩需要先安装zstandard：pip install zstandard'
+    if codec == 'lz4' and lz4 is None:
+        return '使用lz4压缩需要先安装lz4：pip install lz4'
+    if level is not None and codec in CODEC_LEVELS:
+        low, high = CODEC_LEVELS[codec]
+        if not isinstance(level, int) or not low <= level <= high:
+            return f'{codec}的压缩等级应为{low}到{high}之间的整数'
+    return None
+
+
+# 判断文件是否不值得压缩：先看后缀，再对文件开头采样做一次快速压缩测试
+def is_incompressible(file_path):
+    if os.path.splitext(file_path)[1].lower() in INCOMPRESSIBLE_EXTENSIONS:
+        return True
+    try:
+        with open(file_path, 'rb') as f:
+            sample = f.read(SAMPLE_SIZE)
+    except OSError:
+        return False
+    if len(sample) < 4096:
+        return False
+    return len(zlib.compress(sample, 1)) > len(sample) * SAMPLE_RATIO
+
+
+# 打开一个tar流用于写入，按照codec选择压缩算法
+# wrap不为None时用它包装写入的文件对象，比如限制写入速度
+@contextlib.contextmanager
+def open_tar(path, codec, level=None, threads=0, wrap=None):
+    with open(path, 'wb') as raw:
+        out = wrap(raw) if wrap else raw
+        if codec == 'zstd':
+            compressor = zstandard.ZstdCompressor(level=level if level is not None else 3, threads=threads)
+            # stream_writer关闭时会一并关闭raw
+            with compressor.stream_writer(out) as stream, tarfile.open(fileobj=stream, mode='w|') as tar:
+                yield tar
+        elif codec == 'lz4':
+            with lz4.frame.LZ4FrameFile(out, 'wb', compression_level=level if level is not None else 0) as stream, \
+                    tarfile.open(fileobj=stream, mode='w|') as tar:
+                yield tar
+        elif codec == 'gzip':
+            with tarfile.open(fileobj=out, mode='w:gz', compresslevel=level if level is not None else 6) as tar:
+                yield tar
+        elif codec == 'bzip2':
+            with tarfile.open(fileobj=out, mode='w:bz2', compresslevel=level if level is not None else 9) as tar:
+                yield tar
+        elif codec == 'xz':
+            with tarfile.open(fileobj=out, mode='w:xz', preset=level if level is not None else 6) as tar:
+                yield tar
+        else:
+            with tarfile.open(fileobj=out, mode='w') as tar:
+                yield tar
+
+
+# 根据扫描时的stat结果（scanner.ScanEntry）创建普通文件的成员信息，和TarFile.gettarinfo一样，但不需要再stat一次
+# names缓存查询过的用户名和组名，同一个压缩包共用一个字典，不用每个文件都查一次
+def tarinfo_from_entry(entry, names):
+    tarinfo = tarfile.TarInfo(entry.rel_path)
+    tarinfo.type = tarfile.REGTYPE
+    tarinfo.mode = stat.S_IMODE(entry.st_mode)
+    tarinfo.size = entry.st_size
+    tarinfo.mtime = entry.st_mtime_ns / 1e9
+    tarinfo.uid = entry.st_uid
+    tarinfo.gid = entry.st_gid
+    if pwd is not None:
+        key = ('user', entry.st_uid)
+        if key not in names:
+            try:
+                names[key] = pwd.getpwuid(entry.st_uid)[0]
+            except KeyError:
+                names[key] = ''
+        tarinfo.uname = names[key]
+        key = ('group', entry.st_gid)
+        if key not in names:
+            try:
+                names[key] = grp.getgrgid(entry.st_gid)[0]
+            except KeyError:
+                names[key] = ''
+        tarinfo.gname = names[key]
+    return tarinfo
+
+
+# 以流的方式读取open_tar写出的压缩包，压缩算法由文件后缀决定
+@contextlib.contextmanager
+def read_tar(path):
+    if path.endswith(TAR_CODECS['zstd']):
+        with open(path, 'rb') as raw, zstandard.ZstdDecompressor().stream_reader(raw) as stream, \
+                tarfile.open(fileobj=stream, mode='r|') as tar:
+            yield tar
+    elif path.endswith(TAR_CODECS['lz4']):
+        with open(path, 'rb') as raw, lz4.frame.LZ4FrameFile(raw, 'rb') as stream, tarfile.open(fileobj=stream, mode='r|') as tar:
+            yield tar
+    else:
+        with tarfile.open(path, 'r|*') as tar:
+            yield tar
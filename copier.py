@@ -0,0 +1,191 @@
+import os
+import time
+import errno
+import shutil
+import threading
+import collections
+import concurrent.futures
+from checksum import copy_and_hash
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+FICLONE = 0x40049409  # Linux的ioctl，btrfs、XFS等文件系统上克隆文件（reflink），不实际复制数据
+COPY_CHUNK_SIZE = 1024 * 1024 * 64  # copy_file_range和sendfile每次调用复制的大小
+BUFFER_SIZE = 1024 * 1024  # 以上方式都不支持时，用户态复制的缓冲区大小
+
+# 这些错误表示当前文件系统不支持该复制方式，需要换一种方式
+UNSUPPORTED_ERRNOS = {errno.EXDEV, errno.EINVAL, errno.ENOSYS, errno.EOPNOTSUPP, errno.ENOTTY, errno.EBADF, errno.EPERM}
+
+# 记录哪些(源设备, 目标设备)组合不支持某种复制方式，避免每个文件都去试一次
+_unsupported = set()
+_unsupported_lock = threading.Lock()
+
+
+def _mark_unsupported(strategy, devices):
+    with _unsupported_lock:
+        _unsupported.add((strategy, devices))
+
+
+def _supported(strategy, devices):
+    return (strategy, devices) not in _unsupported
+
+
+def _copy_with_reflink(fsrc, fdst):
+    fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+
+
+# 返回实际复制的字节数
+def _copy_with_copy_file_range(fsrc, fdst, size):
+    offset = 0
+    while offset < size:
+        copied = os.copy_file_range(fsrc.fileno(), fdst.fileno(), min(COPY_CHUNK_SIZE, size - offset))
+        if copied == 0:
+            break
+        offset += copied
+    return offset
+
+
+# 返回实际复制的字节数
+def _copy_with_sendfile(fsrc, fdst, size):
+    offset = 0
+    while offset < size:
+        sent = os.sendfile(fdst.fileno(), fsrc.fileno(), offset, min(COPY_CHUNK_SIZE, size - offset))
+        if sent == 0:
+            break
+        offset += sent
+    return offset
+
+
+# 复制单个文件并保留元数据，依次尝试reflink、copy_file_range、sendfile，都不支持时在用户态复制
+# 某种方式失败，或者没有报错但提前结束（有的文件系统会返回0而不是报错）时，会清空目标文件再换下一种，返回实际使用的复制方式
+def copy_file_fast(src, dst, reflink=True):
+    with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+        st = os.fstat(fsrc.fileno())
+        devices = (st.st_dev, os.fstat(fdst.fileno()).st_dev)
+        strategies = []
+        if reflink and fcntl is not None and hasattr(fcntl, 'ioctl'):
+            strategies.append(('reflink', lambda: _copy_with_reflink(fsrc, fdst)))
+        if hasattr(os, 'copy_file_range'):
+            strategies.append(('copy_file_range', lambda: _copy_with_copy_file_range(fsrc, fdst, st.st_size)))
+        if hasattr(os, 'sendfile'):
+            strategies.append(('sendfile', lambda: _copy_with_sendfile(fsrc, fdst, st.st_size)))
+
+        used = None
+        for strategy, func in strategies:
+            if not _supported(strategy, devices):
+                continue
+            try:
+                copied = func()
+                # reflink要么完整克隆要么报错，其他方式要检查是否复制完整
+                if copied is None or copied >= st.st_size:
+                    used = strategy
+                    break
+            except OSError as e:
+                if e.errno not in UNSUPPORTED_ERRNOS:
+                    raise
+                _mark_unsupported(strategy, devices)
+            fsrc.seek(0)
+            fdst.seek(0)
+            fdst.truncate()
+        if used is None:
+            shutil.copyfileobj(fsrc, fdst, BUFFER_SIZE)
+            used = 'userspace'
+        # 数据落盘后才会记录到检查点日志、重命名成最终名字，否则断电后备份里可能是空的或不完整的文件
+        fdst.flush()
+        os.fsync(fdst.fileno())
+    shutil.copystat(src, dst)
+    return used
+
+
+# 删除目标位置上已有的文件，不存在时忽略
+# 中断后继续备份时，临时目录里可能留着上次硬链接过来的文件，它和上一个备份共用同一个inode，
+# 直接以写入方式打开会截断这个inode，把上一个备份里的文件一起改掉，所以写入前要先删除
+def remove_existing(path):
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
+
+
+# 复制一个文件并计时，返回(复制方式, 耗时秒数, 哈希)
+# checksum不为None时在复制的同时计算哈希，只读一遍源文件；throttle限速时分块复制；这两种情况都只能在用户态复制
+def _timed_copy(src, dst, reflink, checksum, throttle):
+    if throttle is not None:
+        throttle.wait_idle()
+    start = time.perf_counter()
+    remove_existing(dst)
+    digest = None
+    if checksum is None and (throttle is None or not throttle.limited):
+        strategy = copy_file_fast(src, dst, reflink)
+    else:
+        digest = copy_and_hash(src, dst, checksum, throttle)
+        shutil.copystat(src, dst)
+        strategy = 'userspace+' + checksum if checksum else 'userspace'
+    return strategy, time.perf_counter() - start, digest
+
+
+# 用线程池同时复制多个文件，适合大量小文件；同时在途的文件数量有上限
+# metrics不为None时，每个文件的大小和耗时会记录到metrics（RunMetrics）里
+# checksum是校验算法，不为None时每个文件的哈希会记录到checksums[key]里
+# throttle（throttle.Throttle）不为None时限制读写速度，系统繁忙时暂停复制
+class ParallelCopier:
+    def __init__(self, workers, reflink=True, metrics=None, checksum=None, checksums=None, throttle=None):
+        self.workers = max(1, workers)
+        self.reflink = reflink
+        self.metrics = metrics
+        self.checksum = checksum
+        self.checksums = checksums if checksums is not None else {}
+        self.throttle = throttle
+        self.strategies = collections.Counter()
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.workers)
+        self.pending = set()
+        self.files = {}  # future -> (源文件, 大小, 复制完成后在调用方线程里执行的回调, 记录哈希用的键)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        try:
+            if exc_type is None:
+                self.wait(0)
+        finally:
+            self.executor.shutdown(wait=True, cancel_futures=exc_type is not None)
+            if exc_type is not None:
+                # 出错退出时，已经复制成功的文件仍然执行回调，中断后继续备份时不必重新复制
+                for future in self.pending:
+                    if not future.cancelled() and future.exception() is None:
+                        self.finish(future)
+
+    # 等到在途的文件数量不超过limit，有文件复制失败时抛出异常
+    def wait(self, limit):
+        while len(self.pending) > limit:
+            done, self.pending = concurrent.futures.wait(self.pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                self.finish(future)
+
+    # 一个文件复制成功后的统计和回调，在调用方线程里执行
+    def finish(self, future):
+        strategy, seconds, digest = future.result()
+        src, size, on_done, key = self.files.pop(future)
+        self.strategies[strategy] += 1
+        if digest is not None:
+            self.checksums[key] = digest
+        if self.metrics is not None:
+            self.metrics.file_done(src, size, seconds)
+        if on_done is not None:
+            on_done()
+
+    # size是源文件大小，只用于统计；on_done在文件复制成功后调用，总是在调用copy的线程里执行，不需要加锁
+    # key是记录哈希用的键（一般是相对路径），默认为目标路径
+    def copy(self, src, dst, size=0, on_done=None, key=None):
+        self.wait(self.workers * 4)
+        future = self.executor.submit(_timed_copy, src, dst, self.reflink, self.checksum, self.throttle)
+        self.pending.add(future)
+        self.files[future] = (src, size, on_done, dst if key is None else key)
+
+    # 用于日志：各复制方式分别用了多少次
+    def summary(self):
+        return '，'.join(f'{strategy} {count}个' for strategy, count in self.strategies.most_common()) or '无'
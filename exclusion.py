@@ -0,0 +1,56 @@
+import re
+
+TERMINAL = ''  # 前缀树中表示“到这里为止的路径被排除”的键，路径的每一段都不会是空字符串
+GLOBAL_FLAGS = re.compile(r'\(\?[aiLmsux]+\)')  # 正则开头的全局标志，比如(?i)
+
+
+# 把相对路径拆成各级名称，统一使用/分隔，去掉开头的/和./
+def split_path(rel_path):
+    return [part for part in rel_path.replace('\\', '/').split('/') if part and part != '.']
+
+
+# 排除规则，copy和zip等所有备份方法共用，保证排除的文件完全一致
+# exclude_path_list：相对源目录的路径，排除这个路径本身以及它下面的所有内容
+# exclude_file_list：正则表达式，从开头匹配文件/文件夹的名称或相对路径（用/分隔），匹配上就排除
+class ExclusionMatcher:
+    def __init__(self, exclude_path_list, exclude_file_list):
+        # 路径排除项按目录层级建成前缀树，判断一个路径只需要沿着树走一遍
+        self.path_trie = {}
+        for path in exclude_path_list or []:
+            parts = split_path(path)
+            if not parts:
+                continue
+            node = self.path_trie
+            for part in parts:
+                node = node.setdefault(part, {})
+            node[TERMINAL] = True
+        # 没有全局标志的正则合并成一个，只编译一次；带(?i)等全局标志的正则不能放在合并后的中间，单独编译
+        plain = [f'(?:{pattern})' for pattern in exclude_file_list or [] if not GLOBAL_FLAGS.match(pattern)]
+        self.patterns = [re.compile('|'.join(plain))] if plain else []
+        self.patterns.extend(re.compile(pattern) for pattern in exclude_file_list or [] if GLOBAL_FLAGS.match(pattern))
+
+    def __bool__(self):
+        return bool(self.path_trie) or bool(self.patterns)
+
+    # 判断相对路径是否在路径排除项中（它自己或者它的某个上级目录被排除）
+    def path_excluded(self, parts):
+        node = self.path_trie
+        for part in parts:
+            node = node.get(part)
+            if node is None:
+                return False
+            if TERMINAL in node:
+                return True
+        return False
+
+    # 判断相对路径对应的文件或文件夹是否需要排除
+    def excluded(self, rel_path):
+        parts = split_path(rel_path)
+        if not parts:
+            return False
+        if self.path_trie and self.path_excluded(parts):
+            return True
+        if self.patterns:
+            name, path = parts[-1], '/'.join(parts)
+            return any(pattern.match(name) or pattern.match(path) for pattern in self.patterns)
+        return False
@@ -0,0 +1,211 @@
+import os
+import re
+import time
+import struct
+import shutil
+import sqlite3
+import zipfile
+from logger_config import logger
+from checksum import CHECKSUM_FILE, load_checksums
+from compression import read_tar
+from journal import PARTIAL_SUFFIX
+
+# 快照索引：记录每个备份里有哪些文件（路径、大小、修改时间、哈希，zip还有成员在压缩包里的位置）
+# 查某个文件的所有版本只需要查一次索引，不用挨个打开备份；从zip里恢复一个文件时直接跳到它的位置读取，不用读中央目录
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS snapshots (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    name TEXT NOT NULL UNIQUE,
+    kind TEXT NOT NULL,
+    created TEXT NOT NULL,
+    files INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS files (
+    snapshot_id INTEGER NOT NULL REFERENCES snapshots (id) ON DELETE CASCADE,
+    path TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    mtime REAL,
+    hash TEXT,
+    header_offset INTEGER,
+    compress_size INTEGER,
+    compress_type INTEGER,
+    crc INTEGER,
+    PRIMARY KEY (path, snapshot_id)
+);
+-- 按备份删除、统计文件时使用，否则删除备份（ON DELETE CASCADE）时要扫描整个files表
+CREATE INDEX IF NOT EXISTS files_snapshot ON files (snapshot_id);
+'''
+LOCAL_HEADER_SIZE = 30  # zip本地文件头的固定部分
+LOCAL_HEADER_SIGNATURE = b'PK\x03\x04'
+RESTORE_CHUNK_SIZE = 1024 * 1024
+
+
+# 获取某个备份项的快照索引路径
+def index_path(destination_dir, file_name):
+    return os.path.join(destination_dir, '.manifest', f'{file_name}.index.db')
+
+
+# 备份的类型：dir（复制、增量、快照）、zip、tar、file（只备份了一个文件），不是备份（校验文件、临时文件等）时返回None
+def snapshot_kind(path):
+    name = os.path.basename(path)
+    if PARTIAL_SUFFIX in name or name.endswith(CHECKSUM_FILE):
+        return None
+    if os.path.isdir(path):
+        return 'dir'
+    if name.endswith('.zip'):
+        return 'zip'
+    if '.tar' in name:
+        return 'tar'
+    return 'file'
+
+
+# zip成员对应的索引条目
+def zipinfo_entry(zinfo, digest=None):
+    return (zinfo.filename, zinfo.file_size, time.mktime(zinfo.date_time + (0, 0, -1)), digest,
+            zinfo.header_offset, zinfo.compress_size, zinfo.compress_type, zinfo.CRC)
+
+
+class SnapshotIndex:
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.conn = sqlite3.connect(path)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA foreign_keys=ON')
+        self.conn.executescript(SCHEMA)
+        self.conn.commit()
+
+    def close(self):
+        self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    # 记录一个备份的所有文件，entries是(路径, 大小, 修改时间, 哈希, zip成员偏移, 压缩后大小, 压缩算法, crc)
+    # 同名的备份已经有索引时整个替换
+    def add_snapshot(self, name, kind, entries):
+        rows = [tuple(entry) for entry in entries]
+        with self.conn:
+            self.conn.execute('DELETE FROM snapshots WHERE name = ?', (name,))
+            snapshot_id = self.conn.execute('INSERT INTO snapshots (name, kind, created, files) VALUES (?, ?, ?, ?)',
+                                            (name, kind, time.strftime("%Y-%m-%d %H:%M:%S", time.localtime()), len(rows))).lastrowid
+            self.conn.executemany('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                                  ((snapshot_id,) + row for row in rows))
+
+    # 删除已经不存在的备份（被手动删除或清理）的索引
+    def prune(self, destination_dir):
+        missing = [name for name in self.snapshot_names() if not os.path.exists(os.path.join(destination_dir, name))]
+        if missing:
+            with self.conn:
+                self.conn.executemany('DELETE FROM snapshots WHERE name = ?', ((name,) for name in missing))
+        return missing
+
+    def snapshot_names(self):
+        return [row['name'] for row in self.conn.execute('SELECT name FROM snapshots ORDER BY name')]
+
+    def snapshots(self):
+        return [dict(row) for row in self.conn.execute('SELECT * FROM snapshots ORDER BY name')]
+
+    # 一个文件在所有备份里的版本，按备份时间排序
+    def versions(self, path):
+        cursor = self.conn.execute('SELECT snapshots.name AS snapshot, snapshots.kind, files.* FROM files '
+                                   'JOIN snapshots ON snapshots.id = files.snapshot_id WHERE files.path = ? ORDER BY snapshots.name',
+                                   (path,))
+        return [dict(row) for row in cursor]
+
+
+# 为还没有索引的已有备份建立索引（比如开启索引之前的备份），返回新建索引的备份数量
+# source_name是源文件名，只备份了一个文件时，索引里用它作为路径
+def build_index(index, destination_dir, file_name, source_name):
+    pattern = re.compile(re.escape(file_name) + r'_\d{4}-\d{2}-\d{2}_\d{2}-\d{2}-\d{2}')
+    indexed = set(index.snapshot_names())
+    count = 0
+    for name in sorted(os.listdir(destination_dir)):
+        path = os.path.join(destination_dir, name)
+        kind = snapshot_kind(path)
+        if not pattern.match(name) or kind is None or name in indexed:
+            continue
+        try:
+            index.add_snapshot(name, kind, _scan_backup(path, kind, source_name))
+            count += 1
+        except Exception as e:
+            logger.warning(f'为{path}建立索引失败，已跳过。错误信息：{str(e)}')
+    return count
+
+
+def _scan_backup(path, kind, source_name):
+    if kind == 'dir':
+        _, _, checksums = load_checksums(os.path.join(path, CHECKSUM_FILE))
+        entries = []
+        for dirpath, _, filenames in os.walk(path):
+            for filename in filenames:
+                file_path = os.path.join(dirpath, filename)
+                rel_path = os.path.relpath(file_path, path).replace(os.sep, '/')
+                if rel_path in (CHECKSUM_FILE, '.deleted'):
+                    continue
+                st = os.stat(file_path)
+                entries.append((rel_path, st.st_size, st.st_mtime, checksums.get(rel_path), None, None, None, None))
+        return entries
+    _, _, checksums = load_checksums(path + CHECKSUM_FILE)
+    if kind == 'zip':
+        with zipfile.ZipFile(path) as zipf:
+            return [zipinfo_entry(zinfo, checksums.get(zinfo.filename)) for zinfo in zipf.infolist() if not zinfo.is_dir()]
+    if kind == 'tar':
+        with read_tar(path) as tar:
+            return [(member.name, member.size, member.mtime, checksums.get(member.name), None, None, None, None)
+                    for member in tar if member.isreg()]
+    st = os.stat(path)
+    return [(source_name, st.st_size, st.st_mtime, next(iter(checksums.values()), None), None, None, None, None)]
+
+
+# 根据索引里记录的位置直接打开zip成员，不读取中央目录
+def open_zip_member(fp, entry):
+    fp.seek(entry['header_offset'])
+    header = fp.read(LOCAL_HEADER_SIZE)
+    if len(header) != LOCAL_HEADER_SIZE or header[:4] != LOCAL_HEADER_SIGNATURE:
+        raise zipfile.BadZipFile(f'{entry["path"]}的位置不是zip成员，压缩包可能被修改过，请重建索引')
+    flag_bits, = struct.unpack('<H', header[6:8])
+    name_length, extra_length = struct.unpack('<HH', header[26:30])
+    name = fp.read(name_length).decode('utf-8' if flag_bits & 0x800 else 'cp437')
+    if name != entry['path']:
+        raise zipfile.BadZipFile(f'{entry["path"]}的位置是{name}，压缩包可能被修改过，请重建索引')
+    fp.seek(extra_length, os.SEEK_CUR)
+    zinfo = zipfile.ZipInfo(name)
+    zinfo.flag_bits = flag_bits
+    zinfo.compress_type = entry['compress_type']
+    zinfo.compress_size = entry['compress_size']
+    zinfo.file_size = entry['size']
+    zinfo.CRC = entry['crc']
+    # ZipExtFile读完时会检查crc
+    return zipfile.ZipExtFile(fp, 'r', zinfo)
+
+
+# 把备份里的一个文件恢复到output_path，entry是SnapshotIndex.versions返回的一项
+def restore_file(backup_path, entry, output_path):
+    os.makedirs(os.path.dirname(os.path.abspath(output_path)), exist_ok=True)
+    kind = entry['kind']
+    if kind == 'dir':
+        shutil.copy2(os.path.join(backup_path, entry['path']), output_path)
+        return
+    if kind == 'file':
+        shutil.copy2(backup_path, output_path)
+        return
+    if kind == 'zip':
+        with open(backup_path, 'rb') as fp, open_zip_member(fp, entry) as src, open(output_path, 'wb') as dst:
+            shutil.copyfileobj(src, dst, RESTORE_CHUNK_SIZE)
+    else:
+        # tar没有目录，只能从头顺序读到这个文件为止
+        with read_tar(backup_path) as tar:
+            for member in tar:
+                if member.name == entry['path'] and member.isreg():
+                    with tar.extractfile(member) as src, open(output_path, 'wb') as dst:
+                        shutil.copyfileobj(src, dst, RESTORE_CHUNK_SIZE)
+                    break
+            else:
+                raise FileNotFoundError(f'{backup_path}里没有{entry["path"]}')
+    if entry['mtime'] is not None:
+        os.utime(output_path, (entry['mtime'], entry['mtime']))
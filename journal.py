@@ -0,0 +1,166 @@
+import os
+import re
+import json
+import time
+import zipfile
+from logger_config import logger
+
+PARTIAL_SUFFIX = '.partial'  # 未完成的备份先写到带这个后缀的临时名字，完成后再原子地重命名
+JOURNAL_SYNC_INTERVAL = 5  # 检查点日志每隔多少秒fsync一次
+TIMESTAMP_PATTERN = re.compile(r'\d{4}-\d{2}-\d{2}_\d{2}-\d{2}-\d{2}')  # 备份名字里的时间戳
+
+
+# 获取某个备份项的检查点日志路径
+# 不同的备份项可能使用相同的file_name和目标文件夹，日志名里带上备份项的名字，各自的日志互不干扰
+def journal_path(destination_dir, file_name, section=''):
+    return os.path.join(destination_dir, '.manifest', f'{file_name}.{section}.journal' if section else f'{file_name}.journal')
+
+
+# 同一秒内开始的两次备份（比如file_name相同的两个备份项）会得到相同的名字
+# 名字或者它的临时名字已经被占用时，在时间戳后面加上_1、_2……，返回一个还没有被占用的名字
+def unique_name(destination_dir, final_name):
+    def taken(name):
+        path = os.path.join(destination_dir, name)
+        return os.path.lexists(path) or os.path.lexists(path + PARTIAL_SUFFIX)
+
+    if not taken(final_name):
+        return final_name
+    matches = list(TIMESTAMP_PATTERN.finditer(final_name))
+    end = matches[-1].end() if matches else len(final_name)
+    n = 1
+    while True:
+        name = f'{final_name[:end]}_{n}{final_name[end:]}'
+        if not taken(name):
+            return name
+        n += 1
+
+
+# 读取检查点日志，返回(头部信息, 已完成的记录)；最后一行可能只写了一半，直接忽略
+def load_journal(path):
+    if not os.path.exists(path):
+        return None, []
+    header = None
+    records = []
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    item = json.loads(line)
+                except ValueError:
+                    break
+                if header is None:
+                    header = item
+                else:
+                    records.append(item)
+    except OSError as e:
+        logger.warning(f'检查点日志{path}读取失败，将重新开始备份。错误信息：{str(e)}')
+        return None, []
+    return header, records
+
+
+# 检查点日志：每完成一个文件追加一行，中断后可以从最后一个完成的文件继续
+# 进程被杀掉时已经写入的行不会丢；断电时最多丢失最近JOURNAL_SYNC_INTERVAL秒的记录，这些文件会被重新备份
+class Journal:
+    def __init__(self, path, header, resume=False):
+        self.path = path
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.file = open(path, 'a' if resume else 'w', encoding='utf-8')
+        if not resume:
+            self.file.write(json.dumps(header, ensure_ascii=False) + '\n')
+            self.sync()
+        self.last_sync = time.time()
+
+    def append(self, record):
+        self.file.write(json.dumps(record, ensure_ascii=False) + '\n')
+        self.file.flush()
+        if time.time() - self.last_sync >= JOURNAL_SYNC_INTERVAL:
+            self.sync()
+
+    def sync(self):
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.last_sync = time.time()
+
+    def close(self):
+        if not self.file.closed:
+            self.file.close()
+
+    # 备份完成并重命名后删除日志
+    def remove(self):
+        self.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+# fsync一个文件夹，保证其中新建、重命名的条目落盘；不支持打开文件夹的系统（Windows）上忽略
+def fsync_dir(path):
+    if not hasattr(os, 'O_DIRECTORY'):
+        return
+    fd = os.open(path, os.O_RDONLY | os.O_DIRECTORY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+# fsync一个已经写完并关闭的文件，用于由别的库负责写入和关闭的文件（比如tar）
+def fsync_file(path):
+    fd = os.open(path, os.O_RDWR)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+# fsync临时文件夹里的所有文件夹，保证硬链接、新建的文件等条目落盘
+# 复制的文件在复制时已经各自fsync过，这里不再重复
+def fsync_tree(path):
+    for dirpath, _, _ in os.walk(path):
+        fsync_dir(dirpath)
+
+
+# 把临时名字原子地重命名为最终名字，并fsync所在目录，保证重命名本身落盘
+# 最终名字已经存在时不重命名：os.rename会直接替换已有的文件，遇到非空文件夹则会失败
+def commit_partial(partial_path, final_path):
+    if os.path.lexists(final_path):
+        raise FileExistsError(f'{final_path}已经存在，不会覆盖')
+    os.rename(partial_path, final_path)
+    fsync_dir(os.path.dirname(os.path.abspath(final_path)))
+
+
+# 压缩包成员写完后记录到日志里的信息，恢复时用来重建压缩包的中央目录
+def zipinfo_to_record(zinfo, end):
+    return {
+        'name': zinfo.filename,
+        'date_time': list(zinfo.date_time),
+        'compress_type': zinfo.compress_type,
+        'flag_bits': zinfo.flag_bits,
+        'external_attr': zinfo.external_attr,
+        'internal_attr': zinfo.internal_attr,
+        'create_system': zinfo.create_system,
+        'create_version': zinfo.create_version,
+        'extract_version': zinfo.extract_version,
+        'extra': zinfo.extra.hex(),
+        'header_offset': zinfo.header_offset,
+        'crc': zinfo.CRC,
+        'compress_size': zinfo.compress_size,
+        'file_size': zinfo.file_size,
+        'end': end,
+    }
+
+
+def zipinfo_from_record(record):
+    zinfo = zipfile.ZipInfo(record['name'], tuple(record['date_time']))
+    zinfo.compress_type = record['compress_type']
+    zinfo.flag_bits = record['flag_bits']
+    zinfo.external_attr = record['external_attr']
+    zinfo.internal_attr = record['internal_attr']
+    zinfo.create_system = record['create_system']
+    zinfo.create_version = record['create_version']
+    zinfo.extract_version = record['extract_version']
+    zinfo.extra = bytes.fromhex(record['extra'])
+    zinfo.header_offset = record['header_offset']
+    zinfo.CRC = record['crc']
+    zinfo.compress_size = record['compress_size']
+    zinfo.file_size = record['file_size']
+    return zinfo
@@ -1,21 +1,29 @@
 from loguru import logger
 import time
 import os
-import yaml
-from auto_backup import CONFIG_FILE
+import sys
 
 this_time = time.strftime("%Y-%m-%d_%H-%M-%S", time.localtime())
 log_file_path = os.path.join('./logs', f'{this_time}.log')
+log_format = '<green>[{time:YYYY-MM-DD HH:mm:ss}]</green> <level>{level}</level> - <cyan>{message}</cyan>'
 
 log_level = 'INFO'
-# 读取配置文件
-config = {}
-with open(CONFIG_FILE, 'r', encoding='utf-8') as f:
-    config = yaml.safe_load(f)
-
-if 'log_level' in config['common'].keys():
-    log_level = config['common']['log_level']
 
 # 配置 Loguru 记录器
-logger.add(log_file_path, level = log_level, format='<green>[{time:YYYY-MM-DD HH:mm:ss}]</green> <level>{level}</level> - <cyan>{message}</cyan>')
-logger.info(f'日志级别：{log_level}')
\ No newline at end of file
+handler_id = logger.add(log_file_path, level = log_level, format=log_format)
+# 控制台也按日志级别过滤，默认的控制台输出是DEBUG级别，逐个文件的日志会拖慢大量文件的备份
+logger.remove(0)
+console_handler_id = logger.add(sys.stderr, level = log_level)
+
+
+# 读取配置文件后再设置日志级别，这样不需要为了日志级别单独解析一次配置文件
+def set_log_level(level):
+    global log_level, handler_id, console_handler_id
+    if not level or level == log_level:
+        return
+    logger.remove(handler_id)
+    logger.remove(console_handler_id)
+    log_level = level
+    handler_id = logger.add(log_file_path, level = log_level, format=log_format)
+    console_handler_id = logger.add(sys.stderr, level = log_level)
+    logger.info(f'日志级别：{log_level}')
@@ -0,0 +1,89 @@
+import os
+import json
+import hashlib
+from logger_config import logger
+from worlds import region_header_digest
+
+MANIFEST_DIR = '.manifest'  # 清单文件存放在目标目录下的这个子目录里
+HASH_CHUNK_SIZE = 1024 * 1024  # 计算哈希时每次读取的块大小，1MB
+
+
+# 获取某个备份项的清单文件路径
+def manifest_path(destination_dir, file_name):
+    return os.path.join(destination_dir, MANIFEST_DIR, f'{file_name}.json')
+
+
+# 获取某个备份项的文件夹索引路径
+def dir_index_path(destination_dir, file_name):
+    return os.path.join(destination_dir, MANIFEST_DIR, f'{file_name}.dirindex.json')
+
+
+# 读取清单文件，不存在或损坏时返回空清单（会触发一次全量备份）
+def load_manifest(path):
+    empty = {'increments': 0, 'last_snapshot': '', 'files': {}}
+    if not os.path.exists(path):
+        return empty
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            manifest = json.load(f)
+    except (OSError, ValueError) as e:
+        logger.warning(f'清单文件{path}读取失败，将进行全量备份。错误信息：{str(e)}')
+        return empty
+    manifest.setdefault('increments', 0)
+    manifest.setdefault('last_snapshot', '')
+    manifest.setdefault('files', {})
+    return manifest
+
+
+# 保存清单文件，先写临时文件再替换，避免写到一半断电导致清单损坏
+def save_manifest(path, manifest):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, ensure_ascii=False)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+# 计算文件内容的哈希
+def hash_file(path):
+    h = hashlib.blake2b(digest_size=32)
+    with open(path, 'rb') as f:
+        while True:
+            chunk = f.read(HASH_CHUNK_SIZE)
+            if not chunk:
+                break
+            h.update(chunk)
+    return h.hexdigest()
+
+
+# 对比文件当前状态和清单中记录的状态，返回(新状态, 是否变化)
+# 大小、修改时间、inode都没变则认为没有变化；开启哈希时，元数据变了但内容没变的文件也会被跳过
+# region为True时（区域文件），元数据变了但大小和区块保存时间表都没变的文件也会被跳过，只需要读取4KB
+def check_file_state(path, st, old, with_hash=False, region=False):
+    state = {'size': st.st_size, 'mtime': st.st_mtime_ns, 'inode': st.st_ino, 'hash': None}
+    if old is None:
+        if region:
+            state['region'] = region_header_digest(path)
+        if with_hash:
+            state['hash'] = hash_file(path)
+        return state, True
+
+    if old.get('size') == st.st_size and old.get('mtime') == st.st_mtime_ns and old.get('inode') == st.st_ino:
+        state['hash'] = old.get('hash')
+        if region:
+            state['region'] = old.get('region')
+        return state, False
+
+    if region:
+        state['region'] = region_header_digest(path)
+        if state['region'] and old.get('region') == state['region'] and old.get('size') == st.st_size:
+            state['hash'] = old.get('hash')
+            return state, False
+
+    if with_hash:
+        state['hash'] = hash_file(path)
+        if old.get('hash') and old.get('size') == st.st_size and old['hash'] == state['hash']:
+            return state, False
+    return state, True
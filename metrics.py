@@ -0,0 +1,149 @@
+import os
+import json
+import time
+import heapq
+import cProfile
+import threading
+import contextlib
+from logger_config import logger
+
+METRICS_FORMATS = ['jsonl', 'prometheus']
+PROGRESS_INTERVAL = 30  # 进度日志的最小间隔，单位秒，代替逐个文件的日志
+SLOW_FILE_SECONDS = 1.0  # 单个文件耗时超过这个值才记为慢文件
+SLOW_FILE_COUNT = 10  # 最多记录多少个最慢的文件
+
+_write_lock = threading.Lock()  # 多个备份项同时结束时，避免同时追加同一个jsonl文件
+
+
+# 一次备份的各阶段耗时、读写量和最慢的文件
+# 只在调用备份方法的线程里更新；复制线程的结果由ParallelCopier在调用方线程里汇总进来
+class RunMetrics:
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.phases = {}  # 阶段名称 -> 累计秒数
+        self.counters = {'bytes_read': 0, 'bytes_output': 0, 'files_excluded': 0, 'dirs_excluded': 0}
+        self.slow_files = []  # 小根堆[(秒数, 路径)]，只保留最慢的SLOW_FILE_COUNT个
+        self.progress_files = 0
+        self.last_progress = self.start
+
+    def add_time(self, name, seconds):
+        self.phases[name] = self.phases.get(name, 0) + seconds
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.perf_counter() - start)
+
+    # 包装一个生成器，只统计生成器本身花的时间（比如扫描），不包括调用方处理每一项的时间
+    def timed_iter(self, name, iterable):
+        iterator = iter(iterable)
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                self.add_time(name, time.perf_counter() - start)
+                return
+            self.add_time(name, time.perf_counter() - start)
+            yield item
+
+    # 一个文件处理完成：累计读取量，记录慢文件，按时间间隔输出一次进度
+    def file_done(self, path, size, seconds):
+        self.counters['bytes_read'] += size
+        self.progress_files += 1
+        if seconds >= SLOW_FILE_SECONDS:
+            if len(self.slow_files) < SLOW_FILE_COUNT:
+                heapq.heappush(self.slow_files, (seconds, path))
+            else:
+                heapq.heappushpop(self.slow_files, (seconds, path))
+        now = time.perf_counter()
+        if now - self.last_progress >= PROGRESS_INTERVAL:
+            self.last_progress = now
+            elapsed = now - self.start
+            logger.info(f'备份进度：已处理{self.progress_files}个文件，读取{self.counters["bytes_read"] / 1024 / 1024:.1f}MB，'
+                        f'平均{self.counters["bytes_read"] / 1024 / 1024 / max(elapsed, 1e-9):.1f}MB/秒')
+
+    # 汇总成一条记录，stats是BackupTask.stats
+    def to_record(self, section, method, start_time, success, stats):
+        duration = time.perf_counter() - self.start
+        phases = dict(self.phases)
+        # 扫描和提交以外的时间都算作写入（复制或压缩）
+        phases['write'] = max(0.0, duration - phases.get('scan', 0) - phases.get('commit', 0))
+        bytes_read = self.counters['bytes_read']
+        return {
+            'section': section,
+            'method': method,
+            'start_time': start_time,
+            'success': bool(success),
+            'duration': duration,
+            'phases': phases,
+            'files': stats.get('files', 0),
+            'bytes_read': bytes_read,
+            'bytes_written': stats.get('bytes_written', 0),
+            'bytes_output': self.counters['bytes_output'],
+            'bytes_skipped': stats.get('bytes_skipped', 0),
+            'bytes_resumed': stats.get('bytes_resumed', 0),
+            'compression_ratio': self.counters['bytes_output'] / bytes_read if bytes_read else None,
+            'files_excluded': self.counters['files_excluded'],
+            'dirs_excluded': self.counters['dirs_excluded'],
+            'slow_files': [{'path': path, 'seconds': seconds} for seconds, path in sorted(self.slow_files, reverse=True)],
+        }
+
+
+def _escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+# 转换成Prometheus文本格式，供node_exporter的textfile collector读取
+def to_prometheus(record):
+    labels = f'section="{_escape_label(record["section"])}",method="{_escape_label(record["method"])}"'
+    lines = [
+        f'auto_backup_success{{{labels}}} {int(record["success"])}',
+        f'auto_backup_last_run_timestamp_seconds{{{labels}}} {time.time():.0f}',
+        f'auto_backup_duration_seconds{{{labels}}} {record["duration"]:.3f}',
+    ]
+    for phase, seconds in record['phases'].items():
+        lines.append(f'auto_backup_phase_seconds{{{labels},phase="{_escape_label(phase)}"}} {seconds:.3f}')
+    for key in ('files', 'bytes_read', 'bytes_written', 'bytes_output', 'bytes_skipped', 'bytes_resumed', 'files_excluded', 'dirs_excluded'):
+        lines.append(f'auto_backup_{key}{{{labels}}} {record[key]}')
+    if record['compression_ratio'] is not None:
+        lines.append(f'auto_backup_compression_ratio{{{labels}}} {record["compression_ratio"]:.4f}')
+    return '\n'.join(lines) + '\n'
+
+
+# 输出一次备份的指标
+# jsonl：追加到metrics_dir/metrics.jsonl，保留所有历史
+# prometheus：每个备份项写一个metrics_dir/auto_backup_<备份项>.prom，只保留最近一次，先写临时文件再替换
+def write_metrics(metrics_dir, metrics_format, record):
+    try:
+        os.makedirs(metrics_dir, exist_ok=True)
+        if metrics_format == 'prometheus':
+            path = os.path.join(metrics_dir, f'auto_backup_{record["section"]}.prom')
+            tmp_path = path + '.tmp'
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                f.write(to_prometheus(record))
+            os.replace(tmp_path, path)
+        else:
+            with _write_lock, open(os.path.join(metrics_dir, 'metrics.jsonl'), 'a', encoding='utf-8') as f:
+                f.write(json.dumps(record, ensure_ascii=False) + '\n')
+    except OSError as e:
+        # 指标写不进去不影响备份本身
+        logger.warning(f'备份指标写入{metrics_dir}失败。错误信息：{str(e)}')
+
+
+# 用cProfile分析一次备份，结果可以用python -m pstats或snakeviz查看
+# cProfile只能分析当前线程，复制线程、扫描线程和并行压缩的子进程不在结果里
+@contextlib.contextmanager
+def profile_run(path):
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        profiler.dump_stats(path)
+        logger.info(f'性能分析结果已保存到{path}')
@@ -0,0 +1,207 @@
+import os
+import time
+import zlib
+import zipfile
+import collections
+import concurrent.futures
+from checksum import block_digest, combine_digests
+
+# 这个模块会在子进程里被导入，所以不要导入logger_config，避免每个子进程都去读配置文件、创建日志文件
+
+PARALLEL_BLOCK_SIZE = 1024 * 1024 * 16  # 大文件按块并行压缩，每块16MB
+DICT_SIZE = 32 * 1024  # deflate的窗口大小，每块用前一块末尾的32KB作为预设字典，压缩率基本不受分块影响
+
+
+# 在子进程中压缩文件的一块，返回(压缩后的数据, 原始数据的crc32, 原始数据长度, 原始数据的哈希, 使用的预设字典, 原始数据末尾32KB)
+# 不是最后一块时用Z_SYNC_FLUSH结束，这样各块的输出可以直接拼接成一个合法的deflate流
+# store为True时不压缩，只计算crc；checksum不为None时顺便计算这一块的哈希（树哈希的叶子），不需要再读一遍
+# zdict为None时从文件里读取这一块前面的32KB作为预设字典，否则使用传入的字典
+def compress_block(file_path, offset, length, level, last, store=False, checksum=None, zdict=None):
+    with open(file_path, 'rb') as f:
+        if zdict is None and not store and offset > 0:
+            dict_offset = max(0, offset - DICT_SIZE)
+            f.seek(dict_offset)
+            zdict = f.read(offset - dict_offset)
+        else:
+            f.seek(offset)
+        data = f.read(length)
+    digest = block_digest(checksum, data) if checksum else None
+    if store:
+        return data, zlib.crc32(data), len(data), digest, None, None
+    if zdict:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -15, zdict=zdict)
+    else:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    compressed = compressor.compress(data) + compressor.flush(zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH)
+    return compressed, zlib.crc32(data), len(data), digest, zdict or b'', data[-DICT_SIZE:]
+
+
+def _gf2_matrix_times(mat, vec):
+    total = 0
+    i = 0
+    while vec:
+        if vec & 1:
+            total ^= mat[i]
+        vec >>= 1
+        i += 1
+    return total
+
+
+def _gf2_matrix_square(mat):
+    return [_gf2_matrix_times(mat, mat[n]) for n in range(32)]
+
+
+# 合并两段数据的crc32，算法来自zlib的crc32_combine，len2是第二段数据的长度
+def crc32_combine(crc1, crc2, len2):
+    if len2 <= 0:
+        return crc1
+    odd = [0xEDB88320] + [1 << n for n in range(31)]
+    even = _gf2_matrix_square(odd)
+    odd = _gf2_matrix_square(even)
+    while True:
+        even = _gf2_matrix_square(odd)
+        if len2 & 1:
+            crc1 = _gf2_matrix_times(even, crc1)
+        len2 >>= 1
+        if not len2:
+            break
+        odd = _gf2_matrix_square(even)
+        if len2 & 1:
+            crc1 = _gf2_matrix_times(odd, crc1)
+        len2 >>= 1
+        if not len2:
+            break
+    return crc1 ^ crc2
+
+
+# 在压缩包中开始写入一个成员，先写一个占位的文件头，写完数据后再回填
+# zipfile没有提供写入已压缩数据的接口，这里按照ZipFile._open_to_write的流程手动写
+def _begin_member(zipf, zinfo, zip64, compress_type):
+    zinfo.compress_type = compress_type
+    zinfo.compress_size = 0
+    zinfo.CRC = 0
+    zinfo.flag_bits = 0x00
+    if not zinfo.external_attr:
+        zinfo.external_attr = 0o600 << 16
+    zipf.fp.seek(zipf.start_dir)
+    zinfo.header_offset = zipf.fp.tell()
+    zipf._writecheck(zinfo)
+    zipf._didModify = True
+    zipf.fp.write(zinfo.FileHeader(zip64))
+    zipf._writing = True
+
+
+# 写完成员数据后回填文件头中的crc和大小，并登记到压缩包的目录中
+def _end_member(zipf, zinfo, zip64, crc, file_size, compress_size):
+    try:
+        zinfo.CRC = crc
+        zinfo.file_size = file_size
+        zinfo.compress_size = compress_size
+        if not zip64 and (file_size > zipfile.ZIP64_LIMIT or compress_size > zipfile.ZIP64_LIMIT):
+            raise RuntimeError(f'{zinfo.filename}在压缩过程中变大，超过了ZIP64的限制')
+        zipf.start_dir = zipf.fp.tell()
+        zipf.fp.seek(zinfo.header_offset)
+        zipf.fp.write(zinfo.FileHeader(zip64))
+        zipf.fp.seek(zipf.start_dir)
+        zipf.filelist.append(zinfo)
+        zipf.NameToInfo[zinfo.filename] = zinfo
+    finally:
+        zipf._writing = False
+
+
+# 根据扫描时的stat结果（scanner.ScanEntry）创建成员信息，和ZipInfo.from_file一样，但不需要再stat一次
+def zipinfo_from_entry(entry):
+    zinfo = zipfile.ZipInfo(entry.rel_path, time.localtime(entry.st_mtime_ns / 1e9)[0:6])
+    zinfo.external_attr = (entry.st_mode & 0xFFFF) << 16  # Unix权限
+    zinfo.file_size = entry.st_size
+    return zinfo
+
+
+# 把文件切成块，生成(扫描结果, 偏移, 长度, 是否最后一块, 是否不压缩)，文件大小使用扫描时的结果
+def _iter_blocks(entries, block_size, store_func):
+    for entry in entries:
+        size = entry.st_size
+        store = bool(store_func and store_func(entry.path))
+        offset = 0
+        while True:
+            length = min(block_size, size - offset)
+            last = offset + length >= size
+            yield entry, offset, length, last, store
+            if last:
+                break
+            offset += length
+
+
+# 用进程池并行压缩entries（scanner.ScanEntry）中的文件，按顺序写入已经打开的zipf
+# entries可以是生成器，边扫描边压缩
+# 同时在途的块数量有上限，内存占用大约是 workers * 2 * block_size * 2
+# store_func(file_path)返回True的文件不压缩，直接存储
+# on_member(zinfo, end, digest)在每个成员完整写入后调用，end是成员结束的位置
+# checksum不为None时，digest是成员原始数据的树哈希，此时block_size必须等于checksum.CHECKSUM_BLOCK_SIZE
+# throttle（throttle.Throttle）不为None时，每块提交给子进程之前按块的大小限制读取速度
+def write_parallel(zipf, entries, workers, level=zlib.Z_DEFAULT_COMPRESSION, block_size=PARALLEL_BLOCK_SIZE,
+                   on_file=None, store_func=None, on_member=None, checksum=None, throttle=None):
+    max_pending = workers * 2
+    blocks = _iter_blocks(entries, block_size, store_func)
+    pending = collections.deque()
+    current = None  # 正在写入的成员：[zinfo, zip64, crc, file_size, compress_size]
+    digests = []  # 正在写入的成员各块的哈希
+    window = b''  # 正在写入的成员已经写入的原始数据的最后32KB，也就是下一块应该使用的预设字典
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+        def submit_next():
+            block = next(blocks, None)
+            if block is None:
+                return False
+            entry, offset, length, last, store = block
+            if throttle is not None:
+                throttle.read(length)
+            pending.append((block, executor.submit(compress_block, entry.path, offset, length, level, last, store, checksum)))
+            return True
+
+        while len(pending) < max_pending and submit_next():
+            pass
+
+        try:
+            while pending:
+                (entry, offset, length, last, store), future = pending.popleft()
+                compressed, crc, data_length, digest, zdict, tail = future.result()
+                submit_next()
+                # 每块的预设字典是子进程另外从文件里读的，文件在备份过程中被原地修改时，可能和上一块实际压缩的数据不一致，
+                # 解压时这个成员会crc校验失败。这时用上一块实际的数据作为字典，在当前进程里重新压缩这一块
+                if offset > 0 and not store and zdict != window:
+                    compressed, crc, data_length, digest, zdict, tail = compress_block(
+                        entry.path, offset, length, level, last, store, checksum, zdict=window)
+
+                if offset == 0:
+                    if on_file:
+                        on_file(entry.path, entry.rel_path)
+                    zinfo = zipinfo_from_entry(entry)
+                    zip64 = zinfo.file_size * 1.05 > zipfile.ZIP64_LIMIT
+                    _begin_member(zipf, zinfo, zip64, zipfile.ZIP_STORED if store else zipfile.ZIP_DEFLATED)
+                    current = [zinfo, zip64, crc, data_length, 0]
+                    digests = []
+                else:
+                    current[2] = crc32_combine(current[2], crc, data_length)
+                    current[3] += data_length
+                if digest is not None:
+                    digests.append(digest)
+
+                if not store:
+                    window = (window + tail)[-DICT_SIZE:] if offset > 0 else tail
+
+                zipf.fp.write(compressed)
+                current[4] += len(compressed)
+
+                if last:
+                    _end_member(zipf, *current)
+                    if on_member:
+                        # 空文件也会有一个长度为0的块，计算树哈希时不算在内
+                        member_digests = digests if current[3] else []
+                        on_member(current[0], zipf.start_dir, combine_digests(checksum, member_digests) if checksum else None)
+                    current = None
+        finally:
+            # 出错时取消还没开始的任务，并解除写入状态，让外层可以正常关闭压缩包
+            for _, future in pending:
+                future.cancel()
+            zipf._writing = False
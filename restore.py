@@ -0,0 +1,86 @@
+# 从备份里查找和恢复单个文件
+# 用法：python restore.py <备份项> --list                      列出这个备份项的所有备份
+#       python restore.py <备份项> <相对路径> --list           列出这个文件在所有备份里的版本
+#       python restore.py <备份项> <相对路径> [--snapshot 备份名] [--output 输出路径]
+#                                                             恢复这个文件，默认恢复最新的版本到当前目录
+#       python restore.py <备份项> --reindex                   为还没有索引的已有备份建立索引
+import os
+import sys
+import time
+import argparse
+from logger_config import logger
+from auto_backup import CONFIG_FILE, load_config
+from index import SnapshotIndex, index_path, build_index, restore_file
+
+
+def format_version(entry):
+    mtime = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(entry['mtime'])) if entry['mtime'] is not None else '-'
+    return f'{entry["snapshot"]}  {entry["size"]:>12}字节  修改时间{mtime}  {entry["hash"] or ""}'
+
+
+def main():
+    parser = argparse.ArgumentParser(description='从备份里查找和恢复单个文件')
+    parser.add_argument('section', help='配置文件里的备份项名称')
+    parser.add_argument('path', nargs='?', help='要查找或恢复的文件，相对源目录的路径（用/分隔）')
+    parser.add_argument('--list', action='store_true', help='列出文件的所有版本；不指定文件时列出所有备份')
+    parser.add_argument('--snapshot', help='从哪个备份恢复，默认最新的包含这个文件的备份')
+    parser.add_argument('--output', help='恢复到哪里，默认当前目录下的同名文件')
+    parser.add_argument('--force', action='store_true', help='输出路径已经存在时覆盖')
+    parser.add_argument('--reindex', action='store_true', help='为还没有索引的已有备份建立索引')
+    args = parser.parse_args()
+
+    config = load_config(CONFIG_FILE)
+    if args.section not in config or args.section in ('common', 'example'):
+        logger.error(f'配置文件中没有备份项{args.section}')
+        sys.exit(1)
+    source_dir = config[args.section].get('source_directory')
+    destination_dir = config[args.section].get('destination_directory', config['common']['global_destination'])
+    file_name = config[args.section].get('file_name', os.path.basename(source_dir))
+
+    with SnapshotIndex(index_path(destination_dir, file_name)) as index:
+        missing = index.prune(destination_dir)
+        if missing:
+            logger.info(f'删除了{len(missing)}个已经不存在的备份的索引')
+        if args.reindex:
+            count = build_index(index, destination_dir, file_name, os.path.basename(source_dir))
+            logger.info(f'为{count}个已有备份建立了索引')
+            if not args.path and not args.list:
+                return
+
+        if not args.path:
+            for snapshot in index.snapshots():
+                print(f'{snapshot["name"]}  {snapshot["kind"]:>4}  {snapshot["files"]:>8}个文件')
+            return
+
+        path = args.path.replace(os.sep, '/').strip('/')
+        versions = index.versions(path)
+        if args.list:
+            for entry in versions:
+                print(format_version(entry))
+            if not versions:
+                logger.warning(f'索引里没有{path}，如果是开启索引之前的备份，可以先用--reindex建立索引')
+            return
+
+        if args.snapshot:
+            versions = [entry for entry in versions if entry['snapshot'] == args.snapshot]
+        if not versions:
+            logger.error(f'{"备份" + args.snapshot if args.snapshot else "索引"}里没有{path}，可以用--list查看这个文件有哪些版本')
+            sys.exit(1)
+        entry = versions[-1]
+        output = args.output or os.path.basename(path)
+        if os.path.isdir(output):
+            output = os.path.join(output, os.path.basename(path))
+        if os.path.exists(output) and not args.force:
+            logger.error(f'{output}已经存在，如需覆盖请加上--force')
+            sys.exit(1)
+        logger.info(f'从{entry["snapshot"]}恢复{path} -> {output}')
+        try:
+            restore_file(os.path.join(destination_dir, entry['snapshot']), entry, output)
+        except Exception as e:
+            logger.error(f'恢复失败：{path} 错误信息：{str(e)}')
+            sys.exit(1)
+        logger.info('恢复完成')
+
+
+if __name__ == '__main__':
+    main()
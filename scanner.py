@@ -0,0 +1,214 @@
+import os
+import json
+import queue
+import threading
+import concurrent.futures
+from logger_config import logger
+
+QUEUE_SIZE = 1000  # 扫描结果队列的长度上限（按文件夹计），备份跟不上扫描时，扫描线程会等待
+
+
+# 扫描到的一个文件或文件夹
+# 属性名和os.stat_result保持一致，可以直接当作stat结果使用，不需要再stat一次
+# st_uid、st_gid只用于tar，不记录到文件夹索引里，从索引中恢复的条目为0
+class ScanEntry:
+    __slots__ = ('path', 'rel_path', 'is_dir', 'st_size', 'st_mtime_ns', 'st_ino', 'st_mode', 'st_uid', 'st_gid')
+
+    def __init__(self, path, rel_path, is_dir, st_size, st_mtime_ns, st_ino, st_mode, st_uid=0, st_gid=0):
+        self.path = path
+        self.rel_path = rel_path
+        self.is_dir = is_dir
+        self.st_size = st_size
+        self.st_mtime_ns = st_mtime_ns
+        self.st_ino = st_ino
+        self.st_mode = st_mode
+        self.st_uid = st_uid
+        self.st_gid = st_gid
+
+    def to_list(self):
+        return [os.path.basename(self.rel_path), self.is_dir, self.st_size, self.st_mtime_ns, self.st_ino, self.st_mode]
+
+
+# 文件夹索引：记录每个文件夹的修改时间和里面的条目
+# 文件夹的修改时间只会在增删、重命名条目时变化，文件被原地修改时不会变化，
+# 所以只有确认源目录里的文件都是整体替换写入时，才适合用索引跳过文件夹
+class DirIndex:
+    def __init__(self, path):
+        self.path = path
+        self.old = {}
+        self.new = {}
+        if os.path.exists(path):
+            try:
+                with open(path, 'r', encoding='utf-8') as f:
+                    self.old = json.load(f)
+            except (OSError, ValueError) as e:
+                logger.warning(f'文件夹索引{path}读取失败，将重新扫描所有文件夹。错误信息：{str(e)}')
+
+    # 文件夹修改时间没变时，返回上次记录的条目
+    def lookup(self, rel_dir, mtime_ns):
+        cached = self.old.get(rel_dir)
+        if cached and cached['mtime'] == mtime_ns:
+            return cached['entries']
+        return None
+
+    def record(self, rel_dir, mtime_ns, entries):
+        self.new[rel_dir] = {'mtime': mtime_ns, 'entries': entries}
+
+    # 扫描完成并且备份成功后再保存
+    def save(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(self.new, f, ensure_ascii=False)
+        os.replace(tmp_path, self.path)
+
+
+def _join(rel_dir, name):
+    return name if rel_dir == '' else rel_dir + '/' + name
+
+
+# 扫描一个文件夹，返回(文件夹下的条目, 需要继续扫描的子文件夹[(路径, 相对路径, 修改时间, 祖先文件夹)], 排除的文件数, 排除的文件夹数)
+# ancestors不为None时进入指向文件夹的符号链接，它是从根目录到这个文件夹的所有文件夹的(st_dev, st_ino)，用来发现链接形成的循环
+def _scan_dir(path, rel_dir, mtime_ns, matcher, index, use_index, ancestors=None):
+    cached = index.lookup(rel_dir, mtime_ns) if index is not None and use_index else None
+    entries = []
+    if cached is not None:
+        for name, is_dir, size, entry_mtime_ns, ino, mode in cached:
+            entries.append(ScanEntry(os.path.join(path, name), _join(rel_dir, name), is_dir, size, entry_mtime_ns, ino, mode))
+    else:
+        with os.scandir(path) as it:
+            for dir_entry in it:
+                try:
+                    is_dir = dir_entry.is_dir(follow_symlinks=False)
+                    if not is_dir and dir_entry.is_symlink() and dir_entry.is_dir():
+                        if ancestors is None:
+                            logger.warning(f'{dir_entry.path}是指向文件夹的符号链接，已跳过')
+                            continue
+                        is_dir = True
+                    if not is_dir and not dir_entry.is_file():
+                        continue
+                    st = dir_entry.stat()
+                except OSError as e:
+                    logger.warning(f'无法读取{dir_entry.path}，已跳过。错误信息：{str(e)}')
+                    continue
+                entries.append(ScanEntry(dir_entry.path, _join(rel_dir, dir_entry.name), is_dir,
+                                         st.st_size, st.st_mtime_ns, st.st_ino, st.st_mode, st.st_uid, st.st_gid))
+
+    result = []
+    subdirs = []
+    excluded_files = 0
+    excluded_dirs = 0
+    for entry in entries:
+        if matcher and matcher.excluded(entry.rel_path):
+            # 逐个文件的日志只在DEBUG级别输出，数量汇总到备份指标里
+            logger.debug(f'排除{"文件夹" if entry.is_dir else "文件"}：{entry.path}')
+            if entry.is_dir:
+                excluded_dirs += 1
+            else:
+                excluded_files += 1
+            continue
+        if entry.is_dir and cached is not None:
+            # 文件夹的修改时间要重新获取，才能判断它下面的内容是否变化
+            try:
+                entry.st_mtime_ns = os.stat(entry.path).st_mtime_ns
+            except OSError:
+                continue
+        sub_ancestors = None
+        if entry.is_dir and ancestors is not None:
+            try:
+                st = os.stat(entry.path)
+            except OSError:
+                continue
+            key = (st.st_dev, st.st_ino)
+            if key in ancestors:
+                logger.warning(f'{entry.path}指向它自己的上级文件夹，形成循环，已跳过')
+                continue
+            sub_ancestors = ancestors + (key,)
+        result.append(entry)
+        if entry.is_dir:
+            subdirs.append((entry.path, entry.rel_path, entry.st_mtime_ns, sub_ancestors))
+    if index is not None:
+        index.record(rel_dir, mtime_ns, [entry.to_list() for entry in entries])
+    return result, subdirs, excluded_files, excluded_dirs
+
+
+def _count_excluded(counts, excluded_files, excluded_dirs):
+    if counts is not None:
+        counts['files_excluded'] += excluded_files
+        counts['dirs_excluded'] += excluded_dirs
+
+
+# 用os.scandir遍历root，边扫描边返回ScanEntry（包括文件夹），被排除的文件夹不会被遍历
+# workers大于1时用多个线程同时扫描不同的子文件夹，返回顺序不固定
+# index不为None时会记录文件夹索引；use_index为True时，修改时间没变的文件夹直接使用索引中的内容
+# counts不为None时，把排除的文件数和文件夹数累加到counts['files_excluded']和counts['dirs_excluded']
+# rel_root是root本身的相对路径，只扫描源目录下的某个子文件夹时，返回的相对路径和排除规则仍然相对源目录
+# follow_symlinks为True时进入指向文件夹的符号链接（和shutil.copytree一样），链接形成循环时跳过；否则跳过这些链接并给出警告
+def scan_tree(root, matcher=None, workers=1, index=None, use_index=False, counts=None, rel_root='', follow_symlinks=False):
+    root_st = os.stat(root)
+    root_mtime_ns = root_st.st_mtime_ns
+    root_ancestors = ((root_st.st_dev, root_st.st_ino),) if follow_symlinks else None
+
+    if workers <= 1:
+        stack = [(root, rel_root, root_mtime_ns, root_ancestors)]
+        while stack:
+            path, rel_dir, mtime_ns, ancestors = stack.pop()
+            try:
+                entries, subdirs, excluded_files, excluded_dirs = _scan_dir(path, rel_dir, mtime_ns, matcher, index, use_index, ancestors)
+            except OSError as e:
+                logger.warning(f'无法读取文件夹{path}，已跳过。错误信息：{str(e)}')
+                continue
+            _count_excluded(counts, excluded_files, excluded_dirs)
+            yield from entries
+            stack.extend(reversed(subdirs))
+        return
+
+    results = queue.Queue(maxsize=QUEUE_SIZE)
+    done = object()
+    stop = threading.Event()
+    lock = threading.Lock()
+    pending = [1]  # 还没扫描完的文件夹数量
+
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+
+    def scan(path, rel_dir, mtime_ns, ancestors):
+        try:
+            if stop.is_set():
+                return
+            try:
+                entries, subdirs, excluded_files, excluded_dirs = _scan_dir(path, rel_dir, mtime_ns, matcher, index, use_index, ancestors)
+            except OSError as e:
+                logger.warning(f'无法读取文件夹{path}，已跳过。错误信息：{str(e)}')
+                return
+            with lock:
+                pending[0] += len(subdirs)
+                _count_excluded(counts, excluded_files, excluded_dirs)
+            for subdir in subdirs:
+                executor.submit(scan, *subdir)
+            # 每个文件夹的结果整体放进队列，减少队列操作
+            if entries:
+                results.put(entries)
+        finally:
+            with lock:
+                pending[0] -= 1
+                finished = pending[0] == 0
+            if finished:
+                results.put(done)
+
+    executor.submit(scan, root, rel_root, root_mtime_ns, root_ancestors)
+    try:
+        while True:
+            item = results.get()
+            if item is done:
+                break
+            yield from item
+    finally:
+        # 调用方提前停止时，让剩下的扫描任务尽快结束，并清空队列避免扫描线程卡住
+        stop.set()
+        while pending[0] > 0 or not results.empty():
+            try:
+                if results.get(timeout=0.1) is done:
+                    break
+            except queue.Empty:
+                pass
+        executor.shutdown(wait=True)
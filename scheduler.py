@@ -0,0 +1,60 @@
+import os
+import collections
+import concurrent.futures
+from logger_config import logger
+
+
+# 获取路径所在的设备号，路径不存在时向上找到第一个存在的父目录
+def device_of(path):
+    path = os.path.abspath(path)
+    while not os.path.exists(path):
+        parent = os.path.dirname(path)
+        if parent == path:
+            break
+        path = parent
+    try:
+        return os.stat(path).st_dev
+    except OSError:
+        return None
+
+
+class SectionJob:
+    def __init__(self, name, priority, source_dir, destination_dir, func):
+        self.name = name
+        self.priority = priority  # 越大越优先
+        self.func = func
+        # 源目录和目标目录所在的设备分别计数，同一块盘既做源又做目标时两边各占一个名额
+        self.devices = [('source', device_of(source_dir)), ('destination', device_of(destination_dir))]
+
+
+# 并发执行多个备份项，总并发数不超过max_workers，每个源设备、目标设备上同时运行的备份项不超过device_limit
+# 优先级高的先启动；某个设备忙时，会跳过它去启动其他设备上的备份项
+# on_done(job, result)在调用run的线程中执行，不需要额外加锁
+def run_jobs(jobs, max_workers, device_limit, on_done):
+    pending = sorted(jobs, key=lambda job: job.priority, reverse=True)
+    usage = collections.Counter()
+    running = {}
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        while pending or running:
+            for job in list(pending):
+                if len(running) >= max_workers:
+                    break
+                if all(usage[device] < device_limit for device in job.devices):
+                    for device in job.devices:
+                        usage[device] += 1
+                    pending.remove(job)
+                    logger.info(f'开始执行备份项{job.name}，当前并发数：{len(running) + 1}')
+                    running[executor.submit(job.func)] = job
+
+            done, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                job = running.pop(future)
+                for device in job.devices:
+                    usage[device] -= 1
+                try:
+                    result = future.result()
+                except Exception as e:
+                    logger.error(f'备份项{job.name}执行出错：{str(e)}')
+                    continue
+                on_done(job, result)
@@ -0,0 +1,92 @@
+import sqlite3
+import threading
+from datetime import datetime
+from logger_config import logger
+
+# 运行状态（上次备份时间、失败次数）和每次备份的历史记录保存在SQLite里，配置文件只由用户编辑，程序不再改写
+# 更新一个备份项只写一行，用WAL模式并且每次提交都落盘，写到一半断电也不会损坏
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS section_state (
+    section TEXT PRIMARY KEY,
+    last_backup_time TEXT NOT NULL DEFAULT '',
+    fail_count INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS run_history (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    section TEXT NOT NULL,
+    method TEXT,
+    start_time TEXT NOT NULL,
+    duration REAL NOT NULL,
+    success INTEGER NOT NULL,
+    files INTEGER NOT NULL DEFAULT 0,
+    bytes_written INTEGER NOT NULL DEFAULT 0,
+    bytes_skipped INTEGER NOT NULL DEFAULT 0,
+    bytes_resumed INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS run_history_section ON run_history (section, start_time);
+'''
+
+
+class StateStore:
+    def __init__(self, path):
+        self.path = path
+        # 备份项在各自的线程里记录历史，连接在线程间共用，用锁保证同一时间只有一个线程在写
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=FULL')
+        self.conn.executescript(SCHEMA)
+        self.conn.commit()
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+    # 读取所有备份项的运行状态，返回{备份项: {'last_backup_time': ..., 'fail_count': ...}}
+    def load(self):
+        with self.lock:
+            rows = self.conn.execute('SELECT section, last_backup_time, fail_count FROM section_state').fetchall()
+        return {section: {'last_backup_time': last_backup_time, 'fail_count': fail_count}
+                for section, last_backup_time, fail_count in rows}
+
+    # 更新一个备份项的运行状态
+    def save(self, section, last_backup_time, fail_count):
+        with self.lock, self.conn:
+            self.conn.execute('INSERT OR REPLACE INTO section_state (section, last_backup_time, fail_count) VALUES (?, ?, ?)',
+                              (section, last_backup_time, fail_count))
+
+    # 记录一次备份的耗时、写入量等信息，供以后分析
+    def record_run(self, section, method, start_time, duration, success, stats):
+        with self.lock, self.conn:
+            self.conn.execute('INSERT INTO run_history (section, method, start_time, duration, success, files, bytes_written, bytes_skipped, bytes_resumed) '
+                              'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                              (section, method, start_time, duration, int(success), stats.get('files', 0),
+                               stats.get('bytes_written', 0), stats.get('bytes_skipped', 0), stats.get('bytes_resumed', 0)))
+
+    # 最近几次备份的历史记录，按时间倒序
+    def history(self, section, limit=10):
+        with self.lock:
+            cursor = self.conn.execute('SELECT * FROM run_history WHERE section = ? ORDER BY id DESC LIMIT ?', (section, limit))
+            columns = [column[0] for column in cursor.description]
+            return [dict(zip(columns, row)) for row in cursor.fetchall()]
+
+    # 把运行状态合并到配置里（只在内存中），备份流程照旧从config读取
+    # 数据库里还没有的备份项，如果配置文件里有旧版本写入的运行状态，就迁移到数据库里
+    def apply(self, config):
+        state = self.load()
+        for section in config.keys():
+            if section == 'common' or section == 'example':
+                continue
+            if section not in state:
+                last_backup_time = config[section].get('last_backup_time', '') or ''
+                # 旧版本写入配置文件时没有加引号，yaml会把时间读成datetime
+                if isinstance(last_backup_time, datetime):
+                    last_backup_time = last_backup_time.strftime("%Y-%m-%d %H:%M:%S")
+                fail_count = config[section].get('fail_count', 0) or 0
+                if last_backup_time != '' or fail_count:
+                    logger.info(f'把{section}的运行状态从配置文件迁移到{self.path}，配置文件里的last_backup_time和fail_count以后不再使用')
+                    self.save(section, str(last_backup_time), fail_count)
+                    state[section] = {'last_backup_time': str(last_backup_time), 'fail_count': fail_count}
+            if section in state:
+                config[section].update(state[section])
+        return config
@@ -0,0 +1,199 @@
+import os
+import time
+import ctypes
+import platform
+import threading
+from logger_config import logger
+
+# 限制备份的读写速度和优先级，避免备份和同一台机器上正在运行的服务抢磁盘和CPU
+
+IONICE_CLASSES = {'': 0, 'best-effort': 2, 'idle': 3}  # 不提供realtime，需要root权限，而且会反过来压制其他服务
+IOPRIO_CLASS_SHIFT = 13
+IOPRIO_WHO_PROCESS = 1  # Linux下传入线程号时只对这个线程生效
+# ioprio_set的系统调用号，glibc没有封装这个函数
+SYS_IOPRIO_SET = {'x86_64': 251, 'i386': 289, 'i686': 289, 'aarch64': 30, 'riscv64': 30, 'armv7l': 314, 'armv6l': 314, 'ppc64le': 273}
+LOAD_CHECK_INTERVAL = 5  # 每隔多少秒检查一次系统负载
+BACKOFF_MIN = 1  # 负载过高时第一次暂停的秒数，之后每次翻倍
+BACKOFF_MAX = 60  # 暂停时间的上限，1分钟平均负载本身也需要这么久才能降下来
+
+
+# 令牌桶：平均速度不超过rate字节/秒，允许最多1秒的突发
+# 一次取的量超过桶里剩余的令牌时先欠着，由这次调用睡眠补齐，大块读写也不会超速
+class TokenBucket:
+    def __init__(self, rate):
+        self.rate = rate
+        self.capacity = rate
+        self.tokens = rate
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def consume(self, n):
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            self.tokens -= n
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+        if wait > 0:
+            time.sleep(wait)
+
+
+# 系统负载监控：每核1分钟平均负载超过max_load，或者两次检查之间的I/O等待占比超过max_iowait（百分比）时认为系统繁忙
+class LoadMonitor:
+    def __init__(self, max_load=0, max_iowait=0):
+        self.max_load = max_load
+        self.max_iowait = max_iowait
+        self.last_cpu_times = None
+
+    # 两次调用之间CPU时间里I/O等待的百分比，没有/proc/stat（非Linux）或第一次调用时返回None
+    def iowait(self):
+        try:
+            with open('/proc/stat', 'r') as f:
+                times = [int(value) for value in f.readline().split()[1:]]
+        except (OSError, ValueError):
+            return None
+        last, self.last_cpu_times = self.last_cpu_times, times
+        if last is None:
+            return None
+        total = sum(times) - sum(last)
+        return (times[4] - last[4]) * 100 / total if total > 0 else None
+
+    # 系统繁忙时返回原因，否则返回None
+    def busy(self):
+        if self.max_load and hasattr(os, 'getloadavg'):
+            load = os.getloadavg()[0] / (os.cpu_count() or 1)
+            if load > self.max_load:
+                return f'每核平均负载{load:.2f}，超过{self.max_load}'
+        if self.max_iowait:
+            iowait = self.iowait()
+            if iowait is not None and iowait > self.max_iowait:
+                return f'I/O等待{iowait:.0f}%，超过{self.max_iowait}%'
+        return None
+
+
+# 一个备份项的限速器，复制线程、压缩流程共用
+# read_rate、write_rate单位字节/秒，0表示不限制；max_load、max_iowait为0表示不检查系统负载
+class Throttle:
+    def __init__(self, read_rate=0, write_rate=0, max_load=0, max_iowait=0):
+        self.read_bucket = TokenBucket(read_rate) if read_rate else None
+        self.write_bucket = TokenBucket(write_rate) if write_rate else None
+        self.monitor = LoadMonitor(max_load, max_iowait) if max_load or max_iowait else None
+        self.limited = bool(read_rate or write_rate)  # 限速时不能用reflink等内核复制方式，需要在用户态分块复制
+        self.next_check = 0
+        self.lock = threading.Lock()
+        self.paused = 0.0  # 因为负载过高累计暂停的秒数
+
+    # 读取n字节前调用
+    def read(self, n):
+        self.wait_idle()
+        if self.read_bucket is not None:
+            self.read_bucket.consume(n)
+
+    # 写入n字节前调用
+    def write(self, n):
+        if self.write_bucket is not None:
+            self.write_bucket.consume(n)
+
+    # 系统繁忙时暂停，暂停时间按指数退避增加，直到负载恢复
+    # 一个线程在暂停时持有锁，其他线程到了检查时间也会等在这里，整个备份项一起暂停
+    def wait_idle(self):
+        if self.monitor is None or time.monotonic() < self.next_check:
+            return
+        with self.lock:
+            if time.monotonic() < self.next_check:
+                return
+            reason = self.monitor.busy()
+            if reason:
+                logger.warning(f'系统繁忙（{reason}），暂停备份')
+                start = time.monotonic()
+                backoff = BACKOFF_MIN
+                while reason:
+                    time.sleep(backoff)
+                    backoff = min(backoff * 2, BACKOFF_MAX)
+                    reason = self.monitor.busy()
+                seconds = time.monotonic() - start
+                self.paused += seconds
+                logger.info(f'系统负载恢复，继续备份，本次暂停{seconds:.0f}秒')
+            self.next_check = time.monotonic() + LOAD_CHECK_INTERVAL
+
+    def reader(self, fileobj):
+        return ThrottledReader(fileobj, self)
+
+    def writer(self, fileobj):
+        return ThrottledWriter(fileobj, self)
+
+
+# 包装一个可读的文件对象，读取时限速，用于tar等由别的库负责读取文件的场景
+class ThrottledReader:
+    def __init__(self, fileobj, throttle):
+        self.fileobj = fileobj
+        self.throttle = throttle
+
+    def read(self, size=-1):
+        data = self.fileobj.read(size)
+        self.throttle.read(len(data))
+        return data
+
+
+# 包装一个可写的文件对象，写入时限速，其他方法（seek、tell、flush等）原样转发，可以交给ZipFile、tarfile使用
+class ThrottledWriter:
+    def __init__(self, fileobj, throttle):
+        self.fileobj = fileobj
+        self.throttle = throttle
+
+    def write(self, data):
+        self.throttle.write(len(data))
+        return self.fileobj.write(data)
+
+    def __getattr__(self, name):
+        return getattr(self.fileobj, name)
+
+
+def set_nice(nice):
+    if not hasattr(os, 'setpriority'):
+        logger.warning('当前系统不支持设置nice，已忽略')
+        return
+    # Linux下PRIO_PROCESS传入线程号时只改变这个线程，之后它创建的线程和子进程都会继承
+    tid = threading.get_native_id()
+    try:
+        if os.getpriority(os.PRIO_PROCESS, tid) < nice:
+            os.setpriority(os.PRIO_PROCESS, tid, nice)
+    except OSError as e:
+        logger.warning(f'设置nice为{nice}失败。错误信息：{str(e)}')
+
+
+def set_ionice(ionice_class, ionice_level=4):
+    number = SYS_IOPRIO_SET.get(platform.machine())
+    if platform.system() != 'Linux' or number is None:
+        logger.warning(f'当前系统（{platform.system()} {platform.machine()}）不支持设置ionice，已忽略')
+        return
+    # idle类没有等级
+    ioprio = (IONICE_CLASSES[ionice_class] << IOPRIO_CLASS_SHIFT) | (ionice_level if ionice_class == 'best-effort' else 0)
+    libc = ctypes.CDLL(None, use_errno=True)
+    if libc.syscall(number, IOPRIO_WHO_PROCESS, threading.get_native_id(), ioprio) != 0:
+        logger.warning(f'设置ionice为{ionice_class}失败。错误信息：{os.strerror(ctypes.get_errno())}')
+
+
+# 以较低的CPU和I/O优先级执行func，返回它的返回值
+# 优先级一旦降低，没有root权限就无法恢复，而备份项是在线程池里运行的，所以放在一个新线程里执行，用完即弃
+def run_with_priority(func, nice=0, ionice_class='', ionice_level=4):
+    if not nice and not ionice_class:
+        return func()
+    result = {}
+
+    def target():
+        if nice:
+            set_nice(nice)
+        if ionice_class:
+            set_ionice(ionice_class, ionice_level)
+        try:
+            result['value'] = func()
+        except BaseException as e:
+            result['error'] = e
+
+    thread = threading.Thread(target=target, name=f'{threading.current_thread().name}-lowprio')
+    thread.start()
+    thread.join()
+    if 'error' in result:
+        raise result['error']
+    return result['value']
@@ -0,0 +1,170 @@
+import os
+import re
+import zlib
+import zipfile
+import threading
+import concurrent.futures
+from logger_config import logger
+from checksum import CHECKSUM_FILE, TreeHasher, hash_block, combine_digests, load_checksums, READ_SIZE
+from compression import read_tar
+from journal import PARTIAL_SUFFIX
+
+# 根据备份时保存的校验文件检查备份是否完整、有没有损坏（静默数据损坏、传输出错等）
+
+
+# 找出一个备份项的所有带校验文件的备份，返回[(备份路径, 校验文件路径)]，按名字排序
+def find_backups(destination_dir, file_name):
+    backups = []
+    if not os.path.isdir(destination_dir):
+        return backups
+    # 名字必须是file_name紧跟时间戳，否则world会匹配到world_nether等其他备份项的备份
+    pattern = re.compile(re.escape(file_name) + r'_\d{4}-\d{2}-\d{2}_\d{2}-\d{2}-\d{2}')
+    for name in sorted(os.listdir(destination_dir)):
+        if not pattern.match(name) or PARTIAL_SUFFIX in name:
+            continue
+        path = os.path.join(destination_dir, name)
+        if os.path.isdir(path):
+            checksum_path = os.path.join(path, CHECKSUM_FILE)
+            if os.path.isfile(checksum_path):
+                backups.append((path, checksum_path))
+        elif name.endswith(CHECKSUM_FILE):
+            backup_path = path[:-len(CHECKSUM_FILE)]
+            if os.path.exists(backup_path):
+                backups.append((backup_path, path))
+            else:
+                logger.warning(f'找到校验文件{path}，但对应的备份已经不存在')
+    return backups
+
+
+# 文件夹形式的备份（复制、增量、快照）：所有文件的所有块一起交给线程池计算，大文件也能多个线程同时校验
+def verify_dir(backup_dir, algorithm, block_size, checksums, workers):
+    bad = []
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        files = {}
+        for rel_path in checksums:
+            path = os.path.join(backup_dir, rel_path)
+            try:
+                size = os.path.getsize(path)
+            except OSError:
+                bad.append((rel_path, '文件不存在'))
+                continue
+            files[rel_path] = [executor.submit(hash_block, path, algorithm, offset, min(block_size, size - offset))
+                               for offset in range(0, size, block_size)]
+        for rel_path, futures in files.items():
+            try:
+                digest = combine_digests(algorithm, [future.result() for future in futures])
+            except OSError as e:
+                bad.append((rel_path, f'读取失败：{str(e)}'))
+                continue
+            if digest != checksums[rel_path]:
+                bad.append((rel_path, '哈希不一致'))
+    return bad
+
+
+# 每个线程单独打开一次压缩包，之后校验的所有成员都复用它，互不影响读取位置
+# 不能每个成员打开一次：打开压缩包要解析整个中央目录，成员多时校验时间会按成员数的平方增长
+# opened记录所有线程打开的压缩包，校验完后统一关闭
+def _hash_zip_member(local, opened, zip_path, zinfo, algorithm, block_size):
+    zipf = getattr(local, 'zipf', None)
+    if zipf is None:
+        zipf = local.zipf = zipfile.ZipFile(zip_path)
+        opened.append(zipf)
+    hasher = TreeHasher(algorithm, block_size)
+    with zipf.open(zinfo) as f:
+        while True:
+            data = f.read(READ_SIZE)
+            if not data:
+                break
+            hasher.update(data)
+    return hasher.hexdigest()
+
+
+# zip：每个成员可以单独解压，多个线程同时校验；解压时zipfile还会顺便检查crc
+def verify_zip(zip_path, algorithm, block_size, checksums, workers):
+    bad = []
+    with zipfile.ZipFile(zip_path) as zipf:
+        members = {zinfo.filename: zinfo for zinfo in zipf.infolist()}
+    local = threading.local()
+    opened = []
+    try:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = {}
+            for rel_path in checksums:
+                if rel_path not in members:
+                    bad.append((rel_path, '压缩包里没有这个文件'))
+                    continue
+                futures[rel_path] = executor.submit(_hash_zip_member, local, opened, zip_path, members[rel_path], algorithm, block_size)
+            for rel_path, future in futures.items():
+                try:
+                    digest = future.result()
+                except (OSError, zipfile.BadZipFile, EOFError, zlib.error) as e:
+                    bad.append((rel_path, f'解压失败：{str(e)}'))
+                    continue
+                if digest != checksums[rel_path]:
+                    bad.append((rel_path, '哈希不一致'))
+    finally:
+        for zipf in opened:
+            zipf.close()
+    return bad
+
+
+# tar：压缩流只能从头到尾顺序读取，不能并行
+def verify_tar(tar_path, algorithm, block_size, checksums):
+    bad = []
+    seen = set()
+    with read_tar(tar_path) as tar:
+        for member in tar:
+            if not member.isreg() or member.name not in checksums:
+                continue
+            seen.add(member.name)
+            hasher = TreeHasher(algorithm, block_size)
+            f = tar.extractfile(member)
+            while True:
+                data = f.read(READ_SIZE)
+                if not data:
+                    break
+                hasher.update(data)
+            if hasher.hexdigest() != checksums[member.name]:
+                bad.append((member.name, '哈希不一致'))
+    bad.extend((rel_path, '压缩包里没有这个文件') for rel_path in checksums if rel_path not in seen)
+    return bad
+
+
+# 校验一个备份，全部一致时返回True
+def verify_backup(backup_path, checksum_path, workers=1):
+    algorithm, block_size, checksums = load_checksums(checksum_path)
+    name = os.path.basename(backup_path)
+    logger.info(f'开始校验备份：{backup_path}，共{len(checksums)}个文件，校验算法：{algorithm}')
+    try:
+        if os.path.isdir(backup_path):
+            bad = verify_dir(backup_path, algorithm, block_size, checksums, workers)
+        elif list(checksums) == [name]:
+            # 只备份了一个文件，校验文件里只有这一个文件
+            bad = verify_dir(os.path.dirname(backup_path), algorithm, block_size, checksums, workers)
+        elif name.endswith('.zip'):
+            bad = verify_zip(backup_path, algorithm, block_size, checksums, workers)
+        else:
+            bad = verify_tar(backup_path, algorithm, block_size, checksums)
+    except Exception as e:
+        logger.error(f'校验失败：{backup_path} 无法读取，错误信息：{str(e)}')
+        return False
+    for rel_path, reason in bad:
+        logger.error(f'校验失败：{backup_path} 中的 {rel_path} {reason}')
+    if bad:
+        logger.error(f'校验完成：{backup_path} 有{len(bad)}个文件损坏或缺失')
+        return False
+    logger.info(f'校验完成：{backup_path} 所有文件完好')
+    return True
+
+
+# 校验一个备份项的所有备份，全部完好时返回True
+def verify_section(destination_dir, file_name, workers=1):
+    backups = find_backups(destination_dir, file_name)
+    if not backups:
+        logger.warning(f'{destination_dir}下没有找到{file_name}的带校验文件的备份，需要在配置里开启verify后再备份')
+        return True
+    ok = True
+    for backup_path, checksum_path in backups:
+        if not verify_backup(backup_path, checksum_path, workers):
+            ok = False
+    return ok
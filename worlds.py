@@ -0,0 +1,65 @@
+import os
+import hashlib
+from logger_config import logger
+
+WORLD_PATTERNS = ['server_world_only', 'mcdr_server_world_only']  # 只备份存档的预定义备份模式
+WORLD_MARKER = 'level.dat'  # 包含这个文件的文件夹就是一个存档
+MCDR_SERVER_DIR = 'server'  # MCDR的服务器工作目录，存档在它下面
+WORLD_SEARCH_DEPTH = 2  # 从服务器目录往下找几层存档，找到存档后不再进入它的子文件夹（下界和末地在原版存档里面）
+REGION_SUFFIXES = ('.mca', '.mcr')  # 区域文件
+REGION_HEADER_OFFSET = 4096  # 区域文件的第二个4KB是1024个区块的最后保存时间（大端序uint32）
+REGION_HEADER_SIZE = 4096
+
+
+# 在服务器目录下查找存档，返回相对源目录的路径列表（用/分隔）
+# 原版服务器只有world一个存档，Bukkit系的world_nether、world_the_end是单独的存档，都会被找到
+def find_worlds(source_dir, mcdr=False):
+    base_rel = MCDR_SERVER_DIR if mcdr else ''
+    base = os.path.join(source_dir, base_rel) if base_rel else source_dir
+    if not os.path.isdir(base):
+        logger.error(f'找不到服务器目录{base}')
+        return []
+
+    worlds = []
+    level = [(base, base_rel)]
+    for depth in range(WORLD_SEARCH_DEPTH + 1):
+        next_level = []
+        for path, rel_path in level:
+            if os.path.isfile(os.path.join(path, WORLD_MARKER)):
+                worlds.append(rel_path)
+                continue
+            if depth == WORLD_SEARCH_DEPTH:
+                continue
+            try:
+                with os.scandir(path) as it:
+                    for entry in it:
+                        if entry.is_dir(follow_symlinks=False):
+                            next_level.append((entry.path, entry.name if rel_path == '' else rel_path + '/' + entry.name))
+            except OSError as e:
+                logger.warning(f'无法读取文件夹{path}，已跳过。错误信息：{str(e)}')
+        level = next_level
+    return sorted(worlds)
+
+
+def is_region_file(path):
+    return path.endswith(REGION_SUFFIXES)
+
+
+# 区域文件头里区块保存时间表的摘要，游戏每次保存一个区块都会更新对应的时间
+# 文件不完整（比如还没有任何区块）时返回None
+def region_header_digest(path):
+    try:
+        with open(path, 'rb') as f:
+            f.seek(REGION_HEADER_OFFSET)
+            table = f.read(REGION_HEADER_SIZE)
+    except OSError:
+        return None
+    if len(table) < REGION_HEADER_SIZE:
+        return None
+    return hashlib.blake2b(table, digest_size=16).hexdigest()
+
+
+# 两个区域文件的区块保存时间表是否完全一致，一致说明没有区块被重新保存过
+def same_region(path, other_path):
+    digest = region_header_digest(path)
+    return digest is not None and digest == region_header_digest(other_path)